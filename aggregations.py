@@ -0,0 +1,319 @@
+"""
+Precomputed aggregates shared by the dashboard views.
+
+The records are reduced into a dense merhav x category x quarter count cube.
+Every linked view (map, trend line, before/after bars) is then answered by
+slicing and summing that small array instead of filtering and grouping the
+records again. When a refresh only appends records, the cube of the new rows
+is merged into the existing one, and the version counters of the merhavim and
+categories it touched are bumped so that only the figures built from them
+need to be redrawn.
+"""
+import threading
+from dataclasses import dataclass, field
+
+import numpy as np
+import pandas as pd
+
+from data_loader import PERIOD_BEFORE, PERIOD_AFTER, FIRST_QUARTER_AFTER, appended_rows
+
+# Names of the merhavim in the records -> names in the PoliceMerhavBoundaries layer
+MERHAV_MAPPING = {
+    "מרחב איילון החדש תא": "מרחב איילון",
+    "מרחב איילון הישן תא": "מרחב איילון",
+    "מרחב לכיש": "מרחב לכיש",
+    "מרחב נגב": "מרחב נגב",
+    "מרחב שרון": "מרחב שרון",
+    "מרחב אילת דרום": "מרחב אילת",
+    "מרחב אשר חוף": "מרחב אשר",
+    "מרחב יהודה שי": "מרחב יהודה",
+    "מרחב גליל צפון": "מרחב גליל",
+    "מרחב ירקון תא": "מרחב ירקון",
+    "מרחב דוד ירושלים": "מרחב דוד",
+    "מרחב שומרון שי": "מרחב שומרון",
+    "מרחב כרמל חוף": "מרחב כרמל",
+    "מרחב שפלה": "מרחב שפלה",
+    "מרחב דן תא": "מרחב דן",
+    "מרחב קדם ירושלים": "מרחב קדם",
+    "מרחב ציון ירושלים": "מרחב ציון",
+    "מרחב כנרת צפון": "מרחב כנרת",
+    "מרחב עמקים צפון": "מרחב עמקים",
+    "מרחב נתבג מרכז": 'מרחב נתב"ג',
+    "מרחב מנשה חוף": "מרחב מנשה",
+}
+
+# Fixed colors of the categories, shared by the dashboards
+CATEGORY_COLORS = {
+    "עבירות פליליות כלליות": "#1f77b4",  # Blue
+    "עבירות מוסר וסדר ציבורי": "#ff7f0e",  # Orange
+    "עבירות ביטחון": "#2ca02c",  # Green
+    "עבירות כלכליות ומנהליות": "#d62728",  # Red
+    "עבירות תנועה": "#9467bd",  # Purple
+    "עבירות מרמה": "#8c564b"  # Brown
+}
+
+
+@dataclass
+class CrimeCube:
+    """
+    Record counts per merhav, category and quarter
+    The last row of the merhav axis holds the records without a known merhav,
+    so national totals are sums over the whole axis.
+    """
+    counts: np.ndarray  # (len(merhavim) + 1) x len(categories) x len(quarters)
+    merhavim: list
+    categories: list
+    quarters: list  # "YYYY-Qn", sorted
+    version: int = 0  # bumped on every change
+    axes_version: int = 0  # bumped when a merhav, category or quarter is added
+    merhav_versions: dict = field(default_factory=dict)  # merhav -> version of its slice
+    category_versions: dict = field(default_factory=dict)  # category -> version of its slice
+
+    def merhav_key(self, merhav=None):
+        """
+        :return: a key that changes whenever the slice of `merhav` (or the national total) changes
+        """
+        if merhav is None:
+            return self.axes_version, self.version
+        return self.axes_version, self.merhav_versions.get(merhav, 0)
+
+    def category_key(self, category=None):
+        """
+        :return: a key that changes whenever the slice of `category` (or the total of all) changes
+        """
+        if category is None:
+            return self.axes_version, self.version
+        return self.axes_version, self.category_versions.get(category, 0)
+
+    def merged(self, other):
+        """
+        Adds the counts of another cube (typically of newly appended records)
+        :param other: CrimeCube
+        :return: a new CrimeCube with the summed counts and the bumped versions
+        """
+        merhavim = sorted(set(self.merhavim) | set(other.merhavim))
+        categories = sorted(set(self.categories) | set(other.categories))
+        quarters = sorted(set(self.quarters) | set(other.quarters))
+        counts = np.zeros((len(merhavim) + 1, len(categories), len(quarters)), dtype=np.int64)
+        for cube in (self, other):
+            merhav_index = [merhavim.index(merhav) for merhav in cube.merhavim] + [len(merhavim)]
+            category_index = [categories.index(category) for category in cube.categories]
+            quarter_index = [quarters.index(quarter) for quarter in cube.quarters]
+            counts[np.ix_(merhav_index, category_index, quarter_index)] += cube.counts
+
+        axes_changed = (merhavim, categories, quarters) != (self.merhavim, self.categories, self.quarters)
+        version = self.version + 1
+        merhav_versions = dict(self.merhav_versions)
+        category_versions = dict(self.category_versions)
+        touched_merhavim = other.counts[:-1].reshape(len(other.merhavim), -1).sum(axis=1) > 0
+        for merhav in np.array(other.merhavim, dtype=object)[touched_merhavim]:
+            merhav_versions[merhav] = version
+        touched_categories = other.counts.sum(axis=(0, 2)) > 0
+        for category in np.array(other.categories, dtype=object)[touched_categories]:
+            category_versions[category] = version
+        return CrimeCube(
+            counts=counts,
+            merhavim=merhavim,
+            categories=categories,
+            quarters=quarters,
+            version=version,
+            axes_version=self.axes_version + int(axes_changed),
+            merhav_versions=merhav_versions,
+            category_versions=category_versions,
+        )
+
+    def merhav_slice(self, merhav=None):
+        """
+        :param merhav: the merhav (None for the whole country)
+        :return: numpy array of counts, categories x quarters (read only)
+        """
+        if merhav is None:
+            return self.counts.sum(axis=0)
+        if merhav not in self.merhavim:
+            return np.zeros(self.counts.shape[1:], dtype=self.counts.dtype)
+        return self.counts[self.merhavim.index(merhav)]
+
+    def trend(self, merhav=None, categories=None):
+        """
+        :param merhav: restrict to one merhav (None for the whole country)
+        :param categories: restrict to these categories (None for all)
+        :return: pandas df with the YearQuarter, Category and Count columns
+        """
+        counts = self.merhav_slice(merhav)
+        trend_df = pd.DataFrame(counts, index=self.categories, columns=self.quarters)
+        if categories is not None:
+            trend_df = trend_df.loc[[category for category in self.categories if category in categories]]
+        return (
+            trend_df.rename_axis(index="Category", columns="YearQuarter")
+            .stack()
+            .reset_index(name="Count")
+        )
+
+    def merhav_totals(self, category=None, year=None):
+        """
+        :param category: restrict to one category (None for all)
+        :param year: restrict to the quarters of one year (None for all)
+        :return: pandas Series of record counts indexed by merhav name
+        """
+        counts = self.counts[:-1]
+        if year is not None:
+            counts = counts[:, :, [quarter.startswith(f"{year}-") for quarter in self.quarters]]
+        if category is not None:
+            if category not in self.categories:
+                return pd.Series(0, index=self.merhavim)
+            counts = counts[:, self.categories.index(category)]
+        return pd.Series(counts.reshape(len(self.merhavim), -1).sum(axis=1), index=self.merhavim)
+
+    def before_after(self, merhav=None):
+        """
+        Counts per category before and after 7.10, normalized per quarter
+        :param merhav: restrict to one merhav (None for the whole country)
+        :return: pandas df with the Category, PERIOD_BEFORE and PERIOD_AFTER columns
+        """
+        counts = self.merhav_slice(merhav)
+        after = np.array([quarter >= FIRST_QUARTER_AFTER for quarter in self.quarters])
+        quarters_before = max(int((~after).sum()), 1)
+        quarters_after = max(int(after.sum()), 1)
+        return pd.DataFrame({
+            "Category": self.categories,
+            PERIOD_BEFORE: np.round(counts[:, ~after].sum(axis=1) / quarters_before),
+            PERIOD_AFTER: np.round(counts[:, after].sum(axis=1) / quarters_after),
+        })
+
+
+def build_crime_cube(df, category_column="Category"):
+    """
+    Reduces the records to a CrimeCube in one vectorized pass
+    :param df: the records, with the YearQuarter, PoliceMerhav and `category_column` columns
+    :param category_column: the column making the category axis (e.g. StatisticGroup for the finer groups)
+    :return: CrimeCube
+    """
+    quarter_codes, quarter_labels = pd.factorize(df["YearQuarter"], sort=True)
+    category_codes, category_labels = pd.factorize(df[category_column], sort=True)
+    merhav_codes, merhav_labels = pd.factorize(df["PoliceMerhav"].map(MERHAV_MAPPING), sort=True)
+    merhav_codes[merhav_codes == -1] = len(merhav_labels)  # records without a known merhav
+
+    shape = (len(merhav_labels) + 1, len(category_labels), len(quarter_labels))
+    flat_index = np.ravel_multi_index((merhav_codes, category_codes, quarter_codes), shape)
+    counts = np.bincount(flat_index, minlength=int(np.prod(shape))).reshape(shape)
+    return CrimeCube(
+        counts=counts,
+        merhavim=list(merhav_labels),
+        categories=list(category_labels),
+        quarters=list(quarter_labels),
+    )
+
+
+_cube_lock = threading.Lock()
+_cube_cache = {}  # category column -> (records frame, its cube)
+
+
+def get_crime_cube(df, category_column="Category"):
+    """
+    Returns the cube of a data snapshot, building it only once per snapshot
+    If the snapshot only appended rows to the one the cached cube was built
+    from, only those rows are aggregated and merged in.
+    :param df: the (shared, unmodified) frame returned by data_loader.get_crime_data
+    :param category_column: the column making the category axis, as in build_crime_cube
+    :return: CrimeCube
+    """
+    with _cube_lock:
+        cached_df, cube = _cube_cache.get(category_column, (None, None))
+        if cached_df is not df:
+            new_rows = appended_rows(cached_df, df) if cube is not None else None
+            if new_rows is None:
+                previous_cube = cube
+                cube = build_crime_cube(df, category_column)
+                if previous_cube is not None:
+                    # a full rebuild changes the key of every slice
+                    cube.version = previous_cube.version + 1
+                    cube.axes_version = previous_cube.axes_version + 1
+            elif not new_rows.empty:
+                cube = cube.merged(build_crime_cube(new_rows, category_column))
+            _cube_cache[category_column] = (df, cube)
+        return cube
+
+
+def preprocess_data_district(df):
+    """
+    preprocessed the districts names
+    :param df: out data frame
+    :return: pandas df with the district names preprocessed
+    """
+    # remove nan values
+    filtered_df = df[~df["PoliceDistrict"].isin(["כל הארץ", ""])]
+
+    # make a joined district
+    aggregated_df = filtered_df.groupby(["Category", "Period"]).agg({"Count": "sum"}).reset_index()
+    aggregated_df["PoliceDistrict"] = "כל המחוזות"
+    combined_df = pd.concat([filtered_df, aggregated_df], ignore_index=True)
+
+    return combined_df
+
+
+def count_district_periods(df):
+    """
+    :param df: the records, with the Category, Period and PoliceDistrict columns
+    :return: pandas Series of record counts indexed by (Category, Period, PoliceDistrict)
+    """
+    return df.groupby(["Category", "Period", "PoliceDistrict"]).size()
+
+
+def district_periods_table(counts):
+    """
+    Turns the counts of count_district_periods into the table the 7.10 charts draw
+    :param counts: pandas Series as returned by count_district_periods
+    :return: pandas df with the Category, Period, PoliceDistrict, Count and NormalizedCount
+             columns, including the joined "כל המחוזות" district
+    """
+    grouped = preprocess_data_district(counts.reset_index(name="Count"))
+
+    # Normalize by quarter count
+    quarters_before = (2023 - 2020) * 4 + 3  # First quarter of 2020 to third quarter of 2023
+    quarters_after = 5  # Fourth quarter of 2023 to fourth quarter of 2024
+    grouped["NormalizedCount"] = (
+        np.where(grouped["Period"] == PERIOD_BEFORE,
+                 grouped["Count"] / quarters_before,
+                 grouped["Count"] / quarters_after)
+        .round()
+        .astype(int)
+    )
+    return grouped
+
+
+def build_district_periods(df):
+    """
+    Counts the records per category, period (before/after 7.10) and police district
+    :param df: the records, with the Category, Period and PoliceDistrict columns
+    :return: pandas df as returned by district_periods_table
+    """
+    return district_periods_table(count_district_periods(df))
+
+
+_district_periods_cache = (None, None, None)  # (records frame, its counts, its district periods)
+
+
+def get_district_periods(df):
+    """
+    Returns the district periods of a data snapshot, building them only once per snapshot
+    If the snapshot only appended rows to the cached one, only those rows are
+    counted and added in; the table is then derived from the (small) counts.
+    :param df: the (shared, unmodified) frame returned by data_loader.get_crime_data
+    :return: pandas df as returned by build_district_periods (shared, do not modify)
+    """
+    global _district_periods_cache
+    with _cube_lock:
+        cached_df, counts, district_periods = _district_periods_cache
+        if cached_df is not df:
+            new_rows = appended_rows(cached_df, df) if counts is not None else None
+            if new_rows is None:
+                counts = count_district_periods(df)
+            elif not new_rows.empty:
+                counts = (
+                    counts.add(count_district_periods(new_rows), fill_value=0)
+                    .sort_index()
+                    .astype(int)
+                )
+            district_periods = district_periods_table(counts)
+            _district_periods_cache = (df, counts, district_periods)
+        return district_periods
@@ -0,0 +1,126 @@
+"""
+Flags unusual quarterly counts of crime series.
+
+Every series (e.g. one merhav x StatisticGroup) is compared with its own
+seasonal baseline: the median of the same quarter of the year across all the
+years. The deviation is scaled by the median absolute deviation of those same
+quarters (robust z = (count - median) / (1.4826 * MAD)), so a few extreme
+quarters do not inflate the baseline they are measured against.
+
+All the series of a cube are scored together: the counts are laid out as
+series x year x quarter-of-year and the medians are taken along the year axis
+in one numpy call, so the cost is linear in the number of cells.
+"""
+import threading
+
+import numpy as np
+import pandas as pd
+
+from aggregations import get_crime_cube
+
+Z_THRESHOLD = 3.5  # the usual cut-off for robust (modified) z-scores
+MIN_EXCESS = 10  # records away from the baseline, so that sparse series do not flood the table
+MIN_HISTORY = 3  # same-quarter years needed for a baseline
+MAD_SCALE = 1.4826  # makes the MAD a consistent estimate of the standard deviation
+
+
+def seasonal_zscores(counts, quarters):
+    """
+    Scores every cell of a batch of quarterly series against its seasonal baseline
+    :param counts: numpy array, any leading axes (the series) x len(quarters)
+    :param quarters: the "YYYY-Qn" labels of the last axis
+    :return: (baseline, zscores) arrays shaped like counts; zscores are NaN where
+             the quarter has fewer than MIN_HISTORY years of history
+    """
+    year_index, years = pd.factorize(pd.Index(quarters).str[:4], sort=True)
+    season_index, seasons = pd.factorize(pd.Index(quarters).str[-1], sort=True)
+
+    # series x year x quarter-of-year, with NaN for the quarters missing from the data
+    grid = np.full(counts.shape[:-1] + (len(years), len(seasons)), np.nan)
+    grid[..., year_index, season_index] = counts
+    median = np.nanmedian(grid, axis=-2)
+    mad = np.nanmedian(np.abs(grid - median[..., np.newaxis, :]), axis=-2)
+    # a series that barely moves has a MAD of zero, fall back to Poisson noise
+    scale = np.maximum(MAD_SCALE * mad, np.sqrt(median + 1))
+    history = (~np.isnan(grid)).sum(axis=-2)
+
+    baseline = median[..., season_index]
+    zscores = (counts - baseline) / scale[..., season_index]
+    zscores[history[..., season_index] < MIN_HISTORY] = np.nan
+    return baseline, zscores
+
+
+def _flagged(counts, quarters, threshold, min_excess):
+    """
+    :return: (index tuple of the flagged cells, counts, baseline and zscores of those cells)
+    """
+    baseline, zscores = seasonal_zscores(counts, quarters)
+    flagged = (np.abs(zscores) >= threshold) & (np.abs(counts - baseline) >= min_excess)
+    index = np.nonzero(flagged)
+    return index, counts[index], baseline[index], zscores[index]
+
+
+def detect_anomalies(cube, category_name="StatisticGroup", threshold=Z_THRESHOLD, min_excess=MIN_EXCESS):
+    """
+    Ranks the unusual counts of every merhav x category series of a cube
+    :param cube: aggregations.CrimeCube
+    :param category_name: the name of the category column of the table
+    :param threshold: minimal absolute robust z-score
+    :param min_excess: minimal absolute difference from the baseline, in records
+    :return: pandas df with the PoliceMerhav, `category_name`, YearQuarter, Count, Baseline
+             and ZScore columns, the most unusual first
+    """
+    # the records without a known merhav are not a place to flag
+    index, counts, baseline, zscores = _flagged(cube.counts[:-1], cube.quarters, threshold, min_excess)
+    merhav_index, category_index, quarter_index = index
+    anomalies = pd.DataFrame({
+        "PoliceMerhav": np.array(cube.merhavim, dtype=object)[merhav_index],
+        category_name: np.array(cube.categories, dtype=object)[category_index],
+        "YearQuarter": np.array(cube.quarters, dtype=object)[quarter_index],
+        "Count": counts,
+        "Baseline": baseline,
+        "ZScore": zscores.round(1),
+    })
+    return anomalies.iloc[np.argsort(-np.abs(zscores), kind="stable")].reset_index(drop=True)
+
+
+def trend_anomalies(cube, merhav=None, threshold=Z_THRESHOLD, min_excess=MIN_EXCESS):
+    """
+    The unusual points of the category trend lines of a merhav (or of the whole country)
+    :param cube: aggregations.CrimeCube
+    :param merhav: the merhav (None for the whole country)
+    :return: pandas df with the Category, YearQuarter, Count, Baseline and ZScore columns
+    """
+    index, counts, baseline, zscores = _flagged(cube.merhav_slice(merhav), cube.quarters,
+                                                threshold, min_excess)
+    category_index, quarter_index = index
+    return pd.DataFrame({
+        "Category": np.array(cube.categories, dtype=object)[category_index],
+        "YearQuarter": np.array(cube.quarters, dtype=object)[quarter_index],
+        "Count": counts,
+        "Baseline": baseline,
+        "ZScore": zscores.round(1),
+    })
+
+
+_anomalies_lock = threading.Lock()
+_anomalies_cache = (None, None)  # (records frame, its anomaly table)
+
+
+def get_anomalies(df):
+    """
+    Returns the ranked merhav x StatisticGroup anomalies of a data snapshot,
+    detecting them only once per snapshot
+    The StatisticGroup cube is kept up to date by get_crime_cube, so a
+    snapshot that only appended rows aggregates just those rows; the scoring
+    runs on the whole (small) cube.
+    :param df: the (shared, unmodified) frame returned by data_loader.get_crime_data
+    :return: pandas df as returned by detect_anomalies (shared, do not modify)
+    """
+    global _anomalies_cache
+    with _anomalies_lock:
+        cached_df, anomalies = _anomalies_cache
+        if cached_df is not df:
+            anomalies = detect_anomalies(get_crime_cube(df, "StatisticGroup"))
+            _anomalies_cache = (df, anomalies)
+        return anomalies
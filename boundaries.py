@@ -0,0 +1,70 @@
+"""
+Access to the police boundary layers of policestationboundaries.gdb.zip.
+"""
+import json
+import os
+import zipfile
+
+import geopandas as gpd
+
+ZIP_PATH = "policestationboundaries.gdb.zip"
+EXTRACT_DIR = "PoliceStationBoundaries"
+GDB_PATH = os.path.join(EXTRACT_DIR, "PoliceStationBoundaries.gdb")
+NAME_COLUMNS = ["MahozName", "MerhavName", "TahanaName"]
+# deepest zoom at which the tile outlines are drawn (the station layer of vector_tiles.LAYERS)
+FILL_MAX_ZOOM = 13
+# one screen pixel at that zoom, in degrees of longitude (512 px map tiles): the
+# simplified fill lines up with the outlines at every zoom they are drawn at
+FILL_TOLERANCE = 360 / (512 * 2 ** FILL_MAX_ZOOM)
+
+
+def extract_zip():
+    """
+    Extracts the boundaries geodatabase next to the zip (once)
+    :return: the path of the extracted .gdb directory
+    """
+    if not os.path.isdir(GDB_PATH):
+        with zipfile.ZipFile(ZIP_PATH, 'r') as zip_ref:
+            zip_ref.extractall(EXTRACT_DIR)
+    return GDB_PATH
+
+
+def read_boundary_layer(layer, epsg=4326):
+    """
+    Reads one of the boundary layers (PoliceMahozBoundaries, PoliceMerhavBoundaries, PoliceStationBoundaries)
+    :param layer: the layer name in the geodatabase
+    :param epsg: reproject to this CRS
+    :return: GeoDataFrame with the name columns cleaned
+    """
+    gdf = gpd.read_file(extract_zip(), layer=layer)
+    gdf = gdf.to_crs(epsg=epsg)
+    for column in NAME_COLUMNS:
+        if column in gdf.columns:
+            gdf[column] = gdf[column].str.strip().str.replace(r'\r\n', '', regex=True)
+    return gdf
+
+
+def read_merhav_boundaries():
+    """
+    Reads the police merhav boundaries, reprojected to WGS84
+    :return: GeoDataFrame with the MerhavName, centroid and unique_id columns
+    """
+    gdf = read_boundary_layer("PoliceMerhavBoundaries")
+    gdf['centroid_lat'] = gdf.geometry.centroid.y
+    gdf['centroid_lon'] = gdf.geometry.centroid.x
+    gdf['unique_id'] = gdf.index
+    return gdf
+
+
+def fill_geojson(gdf, id_column, tolerance=FILL_TOLERANCE):
+    """
+    A light GeoJSON for the fill of a choropleth whose outlines come from the vector tiles
+    :param gdf: WGS84 boundaries
+    :param id_column: the only property kept on the features
+    :param tolerance: simplification tolerance, in degrees (0 keeps the full geometry)
+    :return: GeoJSON dict
+    """
+    light = gdf[[id_column, "geometry"]].copy()
+    if tolerance:
+        light["geometry"] = light.geometry.simplify(tolerance, preserve_topology=True)
+    return json.loads(light.to_json(drop_id=True))
@@ -0,0 +1,318 @@
+"""
+Dash entry point serving the dashboard views as callbacks.
+
+Unlike main.py, which Streamlit re-executes top to bottom on every interaction,
+every chart here is the output of its own callback, so an interaction only
+recomputes the chart whose inputs changed. On the heatmap only the color values
+are sent back (as a Patch); the boundaries stay in the browser. When the vector
+tiles were built (python vector_tiles.py build), they are served under /tiles
+by the same server, the outlines come from them and the fill is simplified.
+
+The data and aggregation layers are the ones main.py uses (data_loader,
+shared_cache, aggregations). Callback results are memoized in a bounded
+FileSystemCache under the shared cache directory, keyed by the data generation,
+so all gunicorn workers of a host share them and a data refresh naturally
+starts new entries. No per-user state is kept on the server, so the app scales
+horizontally by adding workers or hosts:
+
+    gunicorn dash_app:server --workers 4 --bind 0.0.0.0:8050
+
+Put a TLS-terminating reverse proxy in front of the workers. The scheme and
+host of the URLs the server builds (the tile URLs of the TileJSON documents)
+are taken from its X-Forwarded-Proto and X-Forwarded-Host headers; set
+DASH_PROXY_HOPS to the number of proxies in front of the app (0 to ignore the
+headers when the workers are reached directly).
+
+Requires dash>=2.9 and flask-caching on top of the dashboard's dependencies, and
+plotly>=5.24 for the MapLibre map traces (the mapbox ones were removed in plotly 6).
+"""
+import functools
+import os
+
+import plotly.express as px
+import plotly.graph_objects as go
+from dash import Dash, Input, Output, Patch, dcc, html
+from dash.exceptions import PreventUpdate
+from flask import Response, request
+from flask_caching import Cache
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+import shared_cache
+from aggregations import get_crime_cube, get_district_periods, CATEGORY_COLORS, PERIOD_BEFORE, PERIOD_AFTER
+from boundaries import read_merhav_boundaries, fill_geojson, FILL_TOLERANCE
+from data_loader import get_crime_data, data_generation, UpstreamUnavailable, FIRST_QUARTER_AFTER
+from vector_tiles import tile_response, tile_sources, boundary_layers
+
+ALL = "all"
+RTL = {"direction": "rtl", "textAlign": "right"}
+UNAVAILABLE_MESSAGE = "לא ניתן לטעון את הנתונים מ-data.gov.il כרגע. נסו שוב בעוד מספר דקות."
+
+# the error layout of a worker without data has none of the callbacks' components
+app = Dash(__name__, title="Crime Dashboard", suppress_callback_exceptions=True)
+server = app.server
+PROXY_HOPS = int(os.environ.get("DASH_PROXY_HOPS", 1))
+if PROXY_HOPS:
+    # so that request.host_url is the https origin the browser sees, not the proxy's upstream
+    server.wsgi_app = ProxyFix(server.wsgi_app, x_proto=PROXY_HOPS, x_host=PROXY_HOPS)
+cache = Cache(server, config={
+    "CACHE_TYPE": "FileSystemCache",
+    "CACHE_DIR": os.path.join(shared_cache.CACHE_DIR, "dash"),
+    "CACHE_THRESHOLD": int(os.environ.get("DASH_CACHE_ENTRIES", 1000)),  # bounded on disk
+    "CACHE_DEFAULT_TIMEOUT": 0,  # entries are keyed by data generation, they never go stale
+})
+
+
+def current_data():
+    """
+    :return: (records frame, CrimeCube, data generation) of the current snapshot
+    """
+    df, _ = get_crime_data()
+    return df, get_crime_cube(df), data_generation()
+
+
+def current_generation():
+    """
+    :return: the data generation the callbacks key their results by
+    :raises PreventUpdate: if no data could be loaded (the page shows the error instead)
+    """
+    try:
+        _, _, generation = current_data()
+    except UpstreamUnavailable:
+        raise PreventUpdate
+    return generation
+
+
+def data_status_banner(status):
+    """
+    :param status: the DataStatus returned by get_crime_data
+    :return: a staleness badge when the data is served from an old snapshot, otherwise None
+    """
+    if not status.is_degraded:
+        return None
+    return html.Div(
+        [html.Div(line) for line in status.summary()],
+        style={"backgroundColor": "#fff3cd", "color": "#856404", "borderRadius": "6px",
+               "padding": "6px 10px", "fontSize": "14px", "marginBottom": "10px"}
+    )
+
+
+@server.route("/tiles/<path:path>")
+def serve_tiles(path):
+    status, headers, body = tile_response(f"/{path}", f"{request.host_url}tiles", request.args.get("v"),
+                                          request.headers.get("If-None-Match"))
+    return Response(body, status=status, headers=headers)
+
+
+def boundary_tile_sources():
+    """
+    :return: the vector sources of the boundary tiles, or None if they were not built
+    """
+    if os.environ.get("CRIME_TILES_URL"):
+        # a published copy of the tile files, without TileJSON documents
+        return tile_sources(os.environ["CRIME_TILES_URL"], inline=True)
+    return tile_sources("/tiles")
+
+
+@functools.lru_cache(maxsize=1)
+def merhav_boundaries():
+    gdf = read_merhav_boundaries()
+    return gdf, fill_geojson(gdf, "MerhavName", FILL_TOLERANCE if boundary_tile_sources() else 0)
+
+
+# Memoized figures. `generation` is part of the cache key only: the functions
+# read the current snapshot, whose generation it is.
+
+@cache.memoize()
+def overview_figure(year, split_by_quarter, generation):
+    _, cube, _ = current_data()
+    trend_df = cube.trend()
+    trend_df["Year"] = trend_df["YearQuarter"].str[:4]
+    trend_df["Quarter"] = trend_df["YearQuarter"].str[-2:]
+    if year != ALL:
+        trend_df = trend_df[trend_df["Year"] == str(year)]
+    group_by = ["Category", "Quarter"] if split_by_quarter else ["Category"]
+    counts = trend_df.groupby(group_by, as_index=False)["Count"].sum()
+    category_order = (
+        counts.groupby("Category")["Count"].sum().sort_values(ascending=False).index.tolist()
+    )
+    fig = px.bar(
+        counts,
+        x="Category",
+        y="Count",
+        color="Quarter" if split_by_quarter else None,
+        barmode="group",
+        category_orders={"Category": category_order, "Quarter": ["Q1", "Q2", "Q3", "Q4"]},
+        labels={"Category": "סוג פשע", "Count": "כמות העבירות", "Quarter": "רבעון"}
+    )
+    fig.update_layout(plot_bgcolor="#f9f9f9")
+    return fig.to_dict()
+
+
+@cache.memoize()
+def trend_figure(categories, generation):
+    _, cube, _ = current_data()
+    fig = px.line(
+        cube.trend(categories=categories),
+        x="YearQuarter",
+        y="Count",
+        color="Category",
+        color_discrete_map=CATEGORY_COLORS,
+        labels={"YearQuarter": "רבעון", "Count": "מספר עבירות", "Category": ""}
+    )
+    if FIRST_QUARTER_AFTER in cube.quarters:
+        fig.add_vline(x=FIRST_QUARTER_AFTER, line_dash="dash", line_color="gray")
+    fig.update_layout(
+        title=dict(text="פשיעה לאורך השנים לפי סוגי עבירות", x=0.5, xanchor="center"),
+        plot_bgcolor="#f9f9f9",
+        xaxis=dict(categoryorder="array", categoryarray=cube.quarters)
+    )
+    return fig.to_dict()
+
+
+@cache.memoize()
+def october_7_figure(district, generation):
+    df, _, _ = current_data()
+    grouped = get_district_periods(df)
+    pivot_df = (
+        grouped[grouped["PoliceDistrict"] == district]
+        .pivot_table(index="Category", columns="Period", values="NormalizedCount", aggfunc="sum", fill_value=0)
+        .reindex(columns=[PERIOD_BEFORE, PERIOD_AFTER], fill_value=0)
+        .reset_index()
+        .sort_values(by=[PERIOD_BEFORE, PERIOD_AFTER], ascending=False)
+    )
+    fig = px.bar(
+        pivot_df,
+        x="Category",
+        y=[PERIOD_BEFORE, PERIOD_AFTER],
+        barmode="group",
+        labels={"value": "כמות עבירות מנורמלת לרבעון", "variable": "", "Category": "סוגי עבירות"}
+    )
+    fig.update_layout(
+        title=dict(text=f"פשיעה ב{district}", x=1, xanchor="right"),
+        plot_bgcolor="#f9f9f9",
+        legend_title=""
+    )
+    return fig.to_dict()
+
+
+@cache.memoize()
+def heatmap_values(category, year, generation):
+    _, cube, _ = current_data()
+    gdf, _ = merhav_boundaries()
+    totals = cube.merhav_totals(
+        None if category == ALL else category,
+        None if year == ALL else year,
+    )
+    return totals.reindex(gdf["MerhavName"], fill_value=0).tolist()
+
+
+@functools.lru_cache(maxsize=1)
+def base_heatmap_figure():
+    """The map with the boundaries and no values, sent once per page load."""
+    gdf, geojson = merhav_boundaries()
+    tiles = boundary_tile_sources()
+    fig = go.Figure(go.Choroplethmap(
+        geojson=geojson,
+        featureidkey="properties.MerhavName",
+        locations=gdf["MerhavName"],
+        z=[0] * len(gdf),
+        colorscale="Reds",
+        reversescale=True,
+        hovertemplate="<b>%{location}</b><br>מספר עבירות: %{z}<extra></extra>",
+        marker_line_width=0 if tiles else 1,
+        colorbar=dict(title="מספר עבירות")
+    ))
+    fig.update_layout(
+        title=dict(text="2020-2024 מפת עבירות", x=1, xanchor="right"),
+        map=dict(center={"lat": 31.5, "lon": 34.8}, zoom=6.2, style="carto-positron",
+                    layers=boundary_layers(tiles) if tiles else []),
+        height=800,
+        margin=dict(l=20, r=20, t=80, b=20)
+    )
+    return fig.to_dict()
+
+
+def serve_layout():
+    # a function, so that the options and the status follow the current snapshot on every page load
+    try:
+        df, status = get_crime_data()
+    except UpstreamUnavailable:
+        return html.Div(style=RTL, children=[
+            html.H1("פשיעה במדינת ישראל"),
+            html.Div(UNAVAILABLE_MESSAGE, style={"backgroundColor": "#f8d7da", "color": "#721c24",
+                                                 "borderRadius": "6px", "padding": "10px"}),
+        ])
+    cube = get_crime_cube(df)
+    years = sorted({quarter[:4] for quarter in cube.quarters})
+    districts = sorted(get_district_periods(df)["PoliceDistrict"].unique(), key=lambda x: (x != "כל המחוזות", x))
+    year_options = [{"label": "כל השנים", "value": ALL}] + [{"label": year, "value": year} for year in years]
+
+    return html.Div(style=RTL, children=[
+        html.H1("פשיעה במדינת ישראל"),
+        data_status_banner(status),
+        dcc.Tabs([
+            dcc.Tab(label="נתוני הפשיעה במבט על", children=[
+                html.Label("בחר שנה:"),
+                dcc.Dropdown(id="overview-year", options=year_options, value=ALL, clearable=False,
+                             style={"width": "200px"}),
+                dcc.Checklist(id="overview-quarters", options=[{"label": "חלוקה לרבעונים", "value": "split"}],
+                              value=[]),
+                dcc.Graph(id="overview-graph"),
+                html.H3("מגמות פשיעה לאורך זמן"),
+                dcc.Checklist(id="trend-categories", options=cube.categories, value=cube.categories, inline=True),
+                dcc.Graph(id="trend-graph"),
+            ]),
+            dcc.Tab(label="התפלגות סוגי עבירות לפי מרחבים משטרתיים", children=[
+                html.Label("בחר סוג עבירה:"),
+                dcc.Dropdown(id="heatmap-category", clearable=False, style={"width": "200px"}, value=ALL,
+                             options=[{"label": "כל סוגי העבירות", "value": ALL}] + cube.categories),
+                html.Label("בחר שנה:"),
+                dcc.Dropdown(id="heatmap-year", options=year_options, value=ALL, clearable=False,
+                             style={"width": "200px"}),
+                dcc.Graph(id="heatmap-map", figure=base_heatmap_figure()),
+            ]),
+            dcc.Tab(label="השפעות מאורעות ה-7.10.2023 על התפלגות הפשיעה בישראל", children=[
+                html.Label("בחר מחוז:"),
+                dcc.Dropdown(id="district-selector", options=districts, value=districts[0], clearable=False,
+                             style={"width": "200px"}),
+                dcc.Graph(id="october-7-graph"),
+            ]),
+        ]),
+    ])
+
+
+app.layout = serve_layout
+
+
+@app.callback(Output("overview-graph", "figure"),
+              Input("overview-year", "value"), Input("overview-quarters", "value"))
+def update_overview(year, split):
+    generation = current_generation()
+    return overview_figure(year, "split" in split, generation)
+
+
+@app.callback(Output("trend-graph", "figure"), Input("trend-categories", "value"))
+def update_trend(categories):
+    generation = current_generation()
+    return trend_figure(tuple(sorted(categories)), generation)
+
+
+@app.callback(Output("october-7-graph", "figure"), Input("district-selector", "value"))
+def update_october_7(district):
+    generation = current_generation()
+    return october_7_figure(district, generation)
+
+
+@app.callback(Output("heatmap-map", "figure"),
+              Input("heatmap-category", "value"), Input("heatmap-year", "value"))
+def update_heatmap(category, year):
+    generation = current_generation()
+    # only the values and the title travel, the boundaries stay in the browser
+    patched = Patch()
+    patched["data"][0]["z"] = heatmap_values(category, year, generation)
+    patched["layout"]["title"]["text"] = "2020-2024 מפת עבירות" if year == ALL else f"{year} מפת עבירות"
+    return patched
+
+
+if __name__ == "__main__":
+    app.run(debug=False, port=int(os.environ.get("PORT", 8050)))
@@ -0,0 +1,519 @@
+"""
+Resilient loading of the police crime records published on data.gov.il.
+
+Every page of the dashboard reads the records through `get_crime_data`. Each
+yearly resource is fetched with connect/read timeouts, a bounded number of
+retries with jittered exponential backoff and a per-resource circuit breaker.
+Once a resource has been loaded, pages are served from its last good snapshot
+while a background thread refreshes it, so a slow or failing upstream never
+blocks a page.
+
+Streamlit imports this module once per process (unlike main.py, which is
+re-executed on every interaction), so the snapshots and breakers below are
+shared by all sessions and survive reruns. Refreshes are incremental: only
+the records published since the last fetch are downloaded and prepared, and
+the combined frame grows by those rows alone (see `appended_rows`). Across
+processes, fetches go through `shared_cache`: only one worker refreshes a
+resource while the others wait and map its result, and workers reload a year
+whenever its generation in the cache manifest moves past the one they hold.
+"""
+import os
+import random
+import threading
+import time
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime
+
+import pandas as pd
+import requests
+
+import shared_cache
+
+BASE_URL = "https://data.gov.il/api/3/action/datastore_search"
+SQL_URL = "https://data.gov.il/api/3/action/datastore_search_sql"
+PAGE_SIZE = 32000  # records per request, CKAN's default upper bound for `limit`
+RESOURCE_IDS = {
+    2020: "520597e3-6003-4247-9634-0ae85434b971",
+    2021: "3f71fd16-25b8-4cfe-8661-e6199db3eb12",
+    2022: "a59f3e9e-a7fe-4375-97d0-76cea68382c1",
+    2023: "32aacfc9-3524-4fba-a282-3af052380244",
+    2024: "5fc13c50-b6f3-4712-b831-a75e0f91a17e",
+}
+
+CONNECT_TIMEOUT = 3.05  # seconds
+READ_TIMEOUT = 30  # seconds
+MAX_ATTEMPTS = 3
+BACKOFF_BASE = 0.5  # seconds, doubled on every attempt
+BACKOFF_CAP = 8  # seconds
+BREAKER_THRESHOLD = 3  # consecutive failed fetches before the breaker opens
+BREAKER_COOLDOWN = 5 * 60  # seconds before a half-open trial request
+REFRESH_INTERVAL = 6 * 60 * 60  # age after which a snapshot is revalidated
+RETRY_INTERVAL = 60  # minimum gap between two refresh attempts of a resource
+FULL_REFRESH_INTERVAL = 7 * 24 * 60 * 60  # age after which a resource is re-read in full
+APPEND_HISTORY = 8  # number of recent combined frames `appended_rows` can relate
+# CRIME_DATA_OFFLINE=1 serves whatever the shared cache holds and never calls
+# data.gov.il (load tests, demos without network)
+OFFLINE = os.environ.get("CRIME_DATA_OFFLINE") == "1"
+
+
+class UpstreamUnavailable(Exception):
+    """Raised when a resource cannot be fetched from data.gov.il."""
+
+
+class CircuitBreaker:
+    """
+    Stops calling a resource after repeated failures
+    Once `threshold` consecutive fetches have failed the breaker opens and
+    rejects calls for `cooldown` seconds, after which a single trial call is let
+    through (half-open). A successful call closes the breaker again.
+    """
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.time() - self.opened_at >= self.cooldown:
+                # half-open: let this call through and hold the others back
+                # for another cooldown period
+                self.opened_at = time.time()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.time()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+
+@dataclass
+class Snapshot:
+    frame: pd.DataFrame
+    fetched_at: float
+    generation: int
+    error: str = None
+
+
+@dataclass
+class DataStatus:
+    """What the pages need to know about the freshness of the data they show."""
+    fetched_at: dict = field(default_factory=dict)  # year -> last good fetch time
+    stale_years: list = field(default_factory=list)  # served from an old snapshot
+    missing_years: list = field(default_factory=list)  # never fetched successfully
+    refreshing: bool = False
+
+    @property
+    def is_degraded(self):
+        return bool(self.stale_years or self.missing_years)
+
+    def summary(self):
+        """
+        :return: the lines of the staleness badge the dashboards show when degraded
+        """
+        lines = []
+        if self.fetched_at:
+            oldest = datetime.fromtimestamp(min(self.fetched_at.values())).strftime("%d/%m/%Y %H:%M")
+            lines.append(f"הנתונים מוצגים מעותק שמור מ-{oldest}")
+        if self.missing_years:
+            lines.append("שנים חסרות: " + ", ".join(str(year) for year in self.missing_years))
+        if self.refreshing:
+            lines.append("רענון מתבצע ברקע")
+        return lines
+
+
+_breakers = {year: CircuitBreaker() for year in RESOURCE_IDS}
+_snapshots = {}
+_refreshing = set()
+_attempted_at = {}  # year -> start time of the last fetch attempt
+_lock = threading.Lock()
+_cold_start_lock = threading.Lock()
+_cold_started = False
+_combined = None
+_combined_version = 0  # bumped whenever _combined is replaced
+_append_chain = 0  # version of the last combined frame built from scratch
+# (weak ref to a combined frame, its version, its chain): the frames are not
+# kept alive, only related to each other while their holders keep them
+_combined_versions = deque(maxlen=APPEND_HISTORY)
+_manifest_mtime = None
+
+STATISTIC_GROUP_CATEGORIES = {
+    'עבירות כלפי הרכוש': "עבירות פליליות כלליות",
+    'עבירות נגד גוף': "עבירות פליליות כלליות",
+    'עבירות נגד אדם': "עבירות פליליות כלליות",
+    'עבירות מין': "עבירות פליליות כלליות",
+    'עבירות כלפי המוסר': "עבירות מוסר וסדר ציבורי",
+    'עבירות סדר ציבורי': "עבירות מוסר וסדר ציבורי",
+    'עבירות בטחון': "עבירות ביטחון",
+    'עבירות כלכליות': "עבירות כלכליות ומנהליות",
+    'עבירות מנהליות': "עבירות כלכליות ומנהליות",
+    'עבירות רשוי': "עבירות כלכליות ומנהליות",
+    'עבירות תנועה': "עבירות תנועה",
+    'עבירות מרמה': "עבירות מרמה",
+}
+PERIOD_BEFORE = "לפני ה7.10"
+PERIOD_AFTER = "אחרי ה7.10"
+FIRST_QUARTER_AFTER = "2023-Q4"
+
+
+def categorize_statistic_group(stat_group):
+    """
+    Divides the statistic groups into 6
+    :param stat_group: the initial statistic group
+    :return: one of the 6 groups it belongs to
+    """
+    return STATISTIC_GROUP_CATEGORIES.get(stat_group)
+
+
+def prepare_records(records, year):
+    """
+    Builds the frame of a single year (or of the new records of a year) the way the dashboard expects it
+    The derived columns depend on each record alone, so new records can be
+    prepared on their own and appended to the frame of the earlier ones.
+    :param records: the raw records returned by data.gov.il
+    :param year: the year of the resource
+    :return: pandas df with the Year, Category, ReversedStatisticGroup, QuarterNumber,
+             YearQuarter and Period columns
+    """
+    df = pd.DataFrame(records)
+    df['Year'] = int(year)  # Add year column
+    df["Category"] = df["StatisticGroup"].map(STATISTIC_GROUP_CATEGORIES)
+    df = df.dropna(subset=["Category"])
+    df["ReversedStatisticGroup"] = df["Category"].str[::-1]
+    # records without a quarter are counted in the first one, as the trend chart always did
+    df["QuarterNumber"] = (
+        df["Quarter"].astype(str).str.extract(r"(\d)", expand=False).fillna("1").astype(int)
+    )
+    df["YearQuarter"] = str(year) + "-Q" + df["QuarterNumber"].astype(str)
+    df["Period"] = PERIOD_BEFORE
+    df.loc[df["YearQuarter"] >= FIRST_QUARTER_AFTER, "Period"] = PERIOD_AFTER
+    return df
+
+
+def _backoff(attempt):
+    # "full jitter": a random delay up to the capped exponential bound, so that
+    # workers retrying the same resource do not hit it in lockstep
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def _is_retryable(error):
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    return True
+
+
+def _fetch_page(year, url, params):
+    """
+    Calls one data.gov.il action, retrying transient failures
+    :return: the "result" dict of the response
+    :raises UpstreamUnavailable: if every attempt failed
+    """
+    last_error = None
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            response = requests.get(
+                url,
+                params=params,
+                timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+            )
+            response.raise_for_status()
+            payload = response.json()
+            if not payload.get("success"):
+                raise ValueError(f"data.gov.il reported failure: {payload.get('error')}")
+            result = payload["result"]
+            result["records"]  # noqa: B018 - a result without records is a failure too
+        except (requests.RequestException, ValueError, KeyError, TypeError) as error:
+            last_error = error
+            if not _is_retryable(error):
+                break
+            if attempt + 1 < MAX_ATTEMPTS:
+                time.sleep(_backoff(attempt))
+            continue
+        return result
+    raise UpstreamUnavailable(f"could not fetch the {year} resource: {last_error}") from last_error
+
+
+def _fetch_all(year):
+    records = []
+    while True:
+        result = _fetch_page(year, BASE_URL, {
+            "resource_id": RESOURCE_IDS[year],
+            "sort": "_id asc",
+            "limit": PAGE_SIZE,
+            "offset": len(records),
+        })
+        records.extend(result["records"])
+        if not result["records"] or len(records) >= result.get("total", 0):
+            return records
+
+
+def _fetch_after(year, after_id):
+    # keyset paging: ids may have gaps (deleted records), so the new
+    # records are selected by id rather than counted by offset
+    records = []
+    while True:
+        result = _fetch_page(year, SQL_URL, {
+            "sql": f'SELECT * FROM "{RESOURCE_IDS[year]}" WHERE _id > {int(after_id)} '
+                   f'ORDER BY _id LIMIT {PAGE_SIZE}'
+        })
+        page = [
+            {column: value for column, value in record.items() if column != "_full_text"}
+            for record in result["records"]
+        ]
+        # the server may cap a page below PAGE_SIZE, only an empty page ends the listing
+        if not page:
+            return records
+        records.extend(page)
+        after_id = page[-1]["_id"]
+
+
+def fetch_records(year, after_id=None):
+    """
+    Fetches the raw records of one yearly resource, page by page
+    If the SQL endpoint rejects the query selecting the new records (a 4xx,
+    which is not retried), they are picked out of a full read instead.
+    :param year: the year of the resource
+    :param after_id: only fetch the records whose _id is greater than this one
+    :return: list of record dicts, in _id order
+    :raises UpstreamUnavailable: if the breaker is open or a page could not be fetched
+    """
+    if OFFLINE:
+        raise UpstreamUnavailable("offline mode, data.gov.il is not called")
+    breaker = _breakers[year]
+    if not breaker.allow():
+        raise UpstreamUnavailable(f"circuit open for the {year} resource")
+
+    try:
+        if after_id is None:
+            records = _fetch_all(year)
+        else:
+            try:
+                records = _fetch_after(year, after_id)
+            except UpstreamUnavailable as error:
+                if _is_retryable(error.__cause__):
+                    raise
+                records = [record for record in _fetch_all(year) if record["_id"] > after_id]
+    except UpstreamUnavailable:
+        breaker.record_failure()
+        raise
+    breaker.record_success()
+    return records
+
+
+def _set_combined(combined, appended):
+    """Replaces the combined frame, remembering whether it only appended rows to the previous one."""
+    global _combined, _combined_version, _append_chain
+    _combined = combined
+    _combined_version += 1
+    if not appended:
+        _append_chain = _combined_version
+    _combined_versions.append((weakref.ref(combined), _combined_version, _append_chain))
+
+
+def _store_snapshot(year, frame, entry):
+    global _combined
+    with _lock:
+        previous = _snapshots.get(year)
+        if previous is not None and previous.generation == entry["generation"]:
+            # same content, keep the frame the pages already hold
+            previous.fetched_at = entry["fetched_at"]
+            previous.error = entry.get("error")
+            return
+        _snapshots[year] = Snapshot(frame=frame, fetched_at=entry["fetched_at"],
+                                    generation=entry["generation"], error=entry.get("error"))
+        is_append = previous is not None and entry.get("appended_from") is not None \
+            and entry.get("base_generation") == previous.generation
+        if is_append and _combined is not None:
+            _set_combined(pd.concat([_combined, frame.iloc[entry["appended_from"]:]], ignore_index=True),
+                          appended=True)
+        else:
+            _combined = None
+
+
+def _build_year(year, previous, entry):
+    """
+    Builds the frame of a year, fetching only the records published since `previous`
+    Record ids of a resource grow with publication, so the records with an id
+    above the highest one already held are exactly the new ones. The resource is
+    re-read in full once in FULL_REFRESH_INTERVAL, to pick up corrections to old records.
+    :return: (pandas df, manifest fields describing how it was built)
+    """
+    now = time.time()
+    if previous is None or "_id" not in previous.columns or previous.empty \
+            or now - entry.get("full_fetched_at", 0) > FULL_REFRESH_INTERVAL:
+        frame = prepare_records(fetch_records(year), year)
+        return frame, {"full_fetched_at": now, "appended_from": None, "base_generation": None}
+
+    last_id = int(previous["_id"].max())
+    new_records = fetch_records(year, after_id=last_id)
+    if not new_records:
+        return previous, {}
+    frame = pd.concat([previous, prepare_records(new_records, year)], ignore_index=True)
+    return frame, {"appended_from": len(previous), "base_generation": entry.get("generation")}
+
+
+def appended_rows(old_df, new_df):
+    """
+    Returns the rows appended to a combined frame since an earlier one
+    :param old_df: a frame previously returned by get_crime_data
+    :param new_df: the frame returned by get_crime_data now
+    :return: pandas df of the rows appended in between, or None if new_df is not
+             (known to be) old_df with rows appended
+    """
+    with _lock:
+        known = {}
+        for ref, version, chain in _combined_versions:
+            frame = ref()
+            if frame is old_df or frame is new_df:
+                known[id(frame)] = (version, chain)
+    old, new = known.get(id(old_df)), known.get(id(new_df))
+    if old is None or new is None or old[1] != new[1] or old[0] > new[0]:
+        return None
+    # appends keep the rows before them in place, so the new rows are the tail
+    return new_df.iloc[len(old_df):].reset_index(drop=True)
+
+
+def _load_year(year, max_age=REFRESH_INTERVAL):
+    """
+    Refreshes one year through the shared cache and stores it as the year's snapshot
+    :param max_age: age after which the cached frame is rebuilt instead of mapped
+    """
+    def build(previous, entry):
+        with _lock:
+            _attempted_at[year] = time.time()
+        return _build_year(year, previous, entry)
+
+    frame, entry = shared_cache.refresh(
+        str(year),
+        build,
+        max_age=float("inf") if OFFLINE else max_age,
+        retry_interval=RETRY_INTERVAL,
+    )
+    _store_snapshot(year, frame, entry)
+    return frame
+
+
+def _sync_with_shared_cache():
+    """Reloads the years another process refreshed since this one last looked."""
+    global _manifest_mtime
+    try:
+        mtime = os.stat(os.path.join(shared_cache.CACHE_DIR, shared_cache.MANIFEST)).st_mtime_ns
+    except FileNotFoundError:
+        return
+    if mtime == _manifest_mtime:
+        return
+    _manifest_mtime = mtime
+    entries = shared_cache.read_manifest()["entries"]
+    for year in RESOURCE_IDS:
+        entry = entries.get(str(year))
+        snapshot = _snapshots.get(year)
+        if entry is None or "generation" not in entry:
+            continue
+        if snapshot is None or entry["generation"] > snapshot.generation:
+            frame = shared_cache.read_frame(str(year))
+            if frame is not None:
+                _store_snapshot(year, frame, entry)
+
+
+def _refresh_in_background(year):
+    try:
+        _load_year(year)
+    except UpstreamUnavailable:
+        pass  # keep serving the previous snapshot, the status reports it as stale
+    finally:
+        with _lock:
+            _refreshing.discard(year)
+
+
+def _needs_refresh(year, now):
+    if OFFLINE:
+        return False
+    if now - _attempted_at.get(year, 0) <= RETRY_INTERVAL:
+        return False
+    snapshot = _snapshots.get(year)
+    return snapshot is None or snapshot.error is not None \
+        or now - snapshot.fetched_at > REFRESH_INTERVAL
+
+
+def data_generation():
+    """
+    Identifies the content of the snapshots this process holds
+    Processes that synced with the same shared cache return the same value, so
+    it can key results cached across worker processes.
+    :return: str like "2020:3,2021:4,..."
+    """
+    with _lock:
+        return ",".join(f"{year}:{_snapshots[year].generation}" for year in sorted(_snapshots))
+
+
+def get_crime_data():
+    """
+    Returns the records of all years together with their freshness status
+    On a cold process every year is mapped from the shared cache, however old,
+    and only the years the cache does not hold are fetched synchronously (in
+    parallel). After that, pages are always answered from the snapshots at hand
+    and old, failed or missing years are revalidated in background threads.
+    :return: (pandas df of all years, DataStatus)
+    :raises UpstreamUnavailable: if no year could be loaded at all
+    """
+    global _cold_started
+    if not _cold_started:
+        # sessions arriving during the cold start wait for it instead of
+        # fetching the same resources again
+        with _cold_start_lock:
+            if not _cold_started:
+                with ThreadPoolExecutor(max_workers=len(RESOURCE_IDS)) as pool:
+                    # a stale snapshot is served as is, _needs_refresh revalidates it below
+                    futures = [pool.submit(_load_year, year, float("inf")) for year in RESOURCE_IDS]
+                _cold_started = True
+                _sync_with_shared_cache()
+                for future in futures:
+                    error = future.exception()
+                    if error is not None and not isinstance(error, UpstreamUnavailable):
+                        raise error
+    else:
+        _sync_with_shared_cache()
+
+    now = time.time()
+    status = DataStatus()
+    with _lock:
+        for year in RESOURCE_IDS:
+            snapshot = _snapshots.get(year)
+            if snapshot is None:
+                status.missing_years.append(year)
+            else:
+                status.fetched_at[year] = snapshot.fetched_at
+                if snapshot.error is not None or now - snapshot.fetched_at > REFRESH_INTERVAL:
+                    status.stale_years.append(year)
+            if year not in _refreshing and _needs_refresh(year, now):
+                _refreshing.add(year)
+                threading.Thread(target=_refresh_in_background, args=(year,), daemon=True).start()
+        status.refreshing = bool(_refreshing)
+
+        if not _snapshots:
+            raise UpstreamUnavailable("no data could be loaded from data.gov.il")
+        if _combined is None:
+            _set_combined(pd.concat(
+                [_snapshots[year].frame for year in sorted(_snapshots)], ignore_index=True
+            ), appended=False)
+        combined = _combined
+    return combined, status
@@ -0,0 +1,287 @@
+"""
+Concurrent-session load test for the Streamlit dashboard.
+
+Simulates N browser sessions against a single process running main.py, using
+Streamlit's AppTest. Every session runs the interaction scripts below (page
+switches, dropdowns and checkboxes on the sidebar pages) in a loop, and every
+rerun is timed. The data is served offline from the shared cache, so the
+numbers measure the app and not data.gov.il:
+
+    CRIME_CACHE_DIR=.crime_cache python loadtest.py --sessions 8 --iterations 5
+
+The cache directory must already hold a snapshot (any earlier online run of the
+dashboard leaves one behind). The heatmap script also needs clean_df_heatmap.csv
+in the working directory, as the heatmap page reads it from there. The report
+gives p50/p95/p99 rerun latency per action and overall, and the CPU time and
+RSS of the process.
+
+AppTest compiles main.py again on every rerun, and concurrent compiles can fail
+on CPython 3.11 ("AST constructor recursion depth mismatch"). The first run of
+every session is therefore serialized, and a rerun that leaves an empty element
+tree is reported as an error and kept out of the latency figures.
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import threading
+import time
+
+# set before main.py (and with it data_loader) is first imported by AppTest
+os.environ.setdefault("CRIME_DATA_OFFLINE", "1")
+
+import numpy as np
+from streamlit.testing.v1 import AppTest
+
+try:
+    import psutil
+except ImportError:  # fall back to /proc, Linux only
+    psutil = None
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+RERUN_TIMEOUT = 300  # seconds
+
+PAGE_OVERVIEW = "נתוני הפשיעה במבט על"
+PAGE_HEATMAP = "התפלגות סוגי עבירות לפי מרחבים משטרתיים"
+PAGE_OCTOBER_7 = "השפעות מאורעות ה-7.10.2023 על התפלגות הפשיעה בישראל"
+PAGE_LINKED = "ניתוח מקושר: מרחבים, מגמות ו-7.10"
+HEATMAP_CSV = "clean_df_heatmap.csv"
+
+# held while a session runs main.py for the first time, see the module docstring
+_compile_lock = threading.Lock()
+
+
+class ScriptRunFailed(Exception):
+    """Raised when a rerun rendered nothing, e.g. because main.py failed to compile."""
+
+
+def _widget(widgets, label):
+    for widget in widgets:
+        if widget.label == label:
+            return widget
+    raise KeyError(label)
+
+
+def _pick(rng, options):
+    return options[rng.randrange(len(options))]
+
+
+def _reset(defaults):
+    """
+    Restores the default values of widgets left changed by an earlier iteration
+    Scripts only ever change widgets one way, so without this the second
+    iteration would time a different view (e.g. a disabled dropdown).
+    :param defaults: list of (widget, default value) pairs
+    :return: the interaction restoring them, or None if every widget is at its default
+    """
+    changed = [(widget, default) for widget, default in defaults if widget.value != default]
+    if not changed:
+        return None
+    return lambda: [widget.set_value(default) for widget, default in changed]
+
+
+def overview_script(at, rng):
+    yield "overview:open", lambda: at.sidebar.radio[0].set_value(PAGE_OVERVIEW)
+    category_boxes = [box for box in at.checkbox if box.label != "חלוקה לרבעונים"]
+    reset = _reset([(_widget(at.checkbox, "חלוקה לרבעונים"), False)] + [(box, True) for box in category_boxes])
+    if reset:
+        yield "overview:reset", reset
+    year = _widget(at.selectbox, "בחר שנה:")
+    yield "overview:year", lambda: year.set_value(_pick(rng, year.options[1:]))
+    yield "overview:quarters", lambda: _widget(at.checkbox, "חלוקה לרבעונים").check()
+    category_boxes = [box for box in at.checkbox if box.label != "חלוקה לרבעונים"]
+    if category_boxes:
+        yield "overview:category", lambda: _pick(rng, category_boxes).uncheck()
+
+
+def heatmap_script(at, rng):
+    yield "heatmap:open", lambda: at.sidebar.radio[0].set_value(PAGE_HEATMAP)
+    reset = _reset([(_widget(at.checkbox, "הנפשה לאורך כל הרבעונים"), False)])
+    if reset:
+        yield "heatmap:reset", reset
+    crime = _widget(at.selectbox, "בחר סוג עבירה:")
+    yield "heatmap:crime", lambda: crime.set_value(_pick(rng, crime.options))
+    year = _widget(at.selectbox, "בחר שנה:")
+    yield "heatmap:year", lambda: year.set_value(_pick(rng, year.options[1:]))
+    yield "heatmap:animation", lambda: _widget(at.checkbox, "הנפשה לאורך כל הרבעונים").check()
+
+
+def october_7_script(at, rng):
+    yield "oct7:open", lambda: at.sidebar.radio[0].set_value(PAGE_OCTOBER_7)
+    reset = _reset([(at.checkbox(key="districts-small-multiples"), False)])
+    if reset:
+        yield "oct7:reset", reset
+    district = at.selectbox(key="district-selector")
+    yield "oct7:district", lambda: district.set_value(_pick(rng, district.options))
+    yield "oct7:small-multiples", lambda: at.checkbox(key="districts-small-multiples").check()
+
+
+def linked_script(at, rng):
+    # chart selections are client-side events that AppTest cannot produce
+    yield "linked:open", lambda: at.sidebar.radio[0].set_value(PAGE_LINKED)
+
+
+SCRIPTS = {
+    "overview": overview_script,
+    "heatmap": heatmap_script,
+    "oct7": october_7_script,
+    "linked": linked_script,
+}
+
+
+class ResourceSampler(threading.Thread):
+    """Samples the RSS of this process in the background."""
+
+    def __init__(self, interval=0.2):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.samples = []
+        self._stopped = threading.Event()
+
+    @staticmethod
+    def rss():
+        if psutil is not None:
+            return psutil.Process().memory_info().rss
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+    def run(self):
+        while not self._stopped.is_set():
+            self.samples.append(self.rss())
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def run_session(session_id, pages, iterations, seed, start_barrier, timings, errors):
+    """
+    Runs the interaction scripts of one simulated session
+    :param session_id: index of the session, used to seed its choices
+    :param pages: names of the SCRIPTS to run, in order
+    :param iterations: how many times to run the scripts
+    :param seed: base seed of the random choices
+    :param start_barrier: makes all the sessions start interacting together
+    :param timings: list collecting (action, seconds) tuples
+    :param errors: list collecting (action, message) tuples
+    """
+    rng = random.Random(seed + session_id)
+    at = AppTest.from_file(APP_PATH, default_timeout=RERUN_TIMEOUT)
+    start_barrier.wait()
+
+    def timed_run(action):
+        started = time.perf_counter()
+        at.run()
+        seconds = time.perf_counter() - started
+        if not at.main.children and not at.sidebar.children:
+            # a failed compile is only logged by Streamlit, not put in at.exception
+            errors.append((action, "script run failed: empty element tree, see the Streamlit log"))
+            raise ScriptRunFailed(action)
+        timings.append((action, seconds))
+        for exception in at.exception:
+            errors.append((action, exception.message))
+
+    def serialized_run(action):
+        with _compile_lock:
+            timed_run(action)
+
+    failed = False
+    try:
+        serialized_run("session:start")
+    except ScriptRunFailed:
+        failed = True
+    for _ in range(iterations):
+        for page in pages:
+            try:
+                if failed:
+                    # the widgets of the failed run are gone, render the page again first
+                    serialized_run("session:rerun")
+                    failed = False
+                for action, interact in SCRIPTS[page](at, rng):
+                    interact()
+                    timed_run(action)
+            except ScriptRunFailed:
+                failed = True
+            except (KeyError, IndexError) as error:
+                # a widget the script expects is missing, e.g. the page failed to render
+                errors.append((page, f"widget not found: {error!r}"))
+
+
+def percentiles(values):
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"count": len(values), "p50": p50, "p95": p95, "p99": p99, "max": max(values)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sessions", type=int, default=4, help="number of concurrent sessions")
+    parser.add_argument("--iterations", type=int, default=3, help="script repetitions per session")
+    parser.add_argument("--pages", nargs="+", choices=list(SCRIPTS), default=list(SCRIPTS),
+                        help="interaction scripts to run")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+    if "heatmap" in args.pages and not os.path.exists(HEATMAP_CSV):
+        parser.error(f"the heatmap script needs {HEATMAP_CSV} in the working directory "
+                     f"(or leave it out with --pages)")
+
+    timings, errors = [], []
+    barrier = threading.Barrier(args.sessions)
+    sampler = ResourceSampler()
+    sampler.start()
+    cpu_started, wall_started = time.process_time(), time.perf_counter()
+
+    sessions = [
+        threading.Thread(target=run_session,
+                         args=(i, args.pages, args.iterations, args.seed, barrier, timings, errors))
+        for i in range(args.sessions)
+    ]
+    for session in sessions:
+        session.start()
+    for session in sessions:
+        session.join()
+
+    wall = time.perf_counter() - wall_started
+    cpu = time.process_time() - cpu_started
+    sampler.stop()
+
+    by_action = {}
+    for action, seconds in timings:
+        by_action.setdefault(action, []).append(seconds)
+    report = {
+        "sessions": args.sessions,
+        "iterations": args.iterations,
+        "pages": args.pages,
+        "wall_seconds": wall,
+        "cpu_seconds": cpu,
+        "cpu_utilization": cpu / wall if wall else 0,  # > 1 means more than one core busy
+        "rss_peak_mb": max(sampler.samples + [sampler.rss()]) / 2 ** 20,
+        "rss_max_lifetime_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "reruns": percentiles([seconds for _, seconds in timings]) if timings else None,
+        "actions": {action: percentiles(values) for action, values in sorted(by_action.items())},
+        "errors": errors,
+    }
+
+    print(f"{args.sessions} sessions x {args.iterations} iterations, {len(timings)} reruns in {wall:.1f}s")
+    print(f"CPU {cpu:.1f}s ({report['cpu_utilization']:.0%} of one core), "
+          f"RSS peak {report['rss_peak_mb']:.0f} MB")
+    print(f"{'action':<24}{'n':>6}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    rows = list(report["actions"].items())
+    if report["reruns"]:
+        rows.append(("all reruns", report["reruns"]))
+    for action, stats in rows:
+        print(f"{action:<24}{stats['count']:>6}" + "".join(
+            f"{stats[key] * 1000:>7.0f}ms" for key in ("p50", "p95", "p99", "max")
+        ))
+    if errors:
+        print(f"{len(errors)} errors, first: {errors[0]}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as report_file:
+            json.dump(report, report_file, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
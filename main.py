@@ -1,86 +1,459 @@
-import zipfile
+import os
+from urllib.parse import urlsplit
 import plotly.express as px
+import plotly.graph_objects as go
 import streamlit as st
 import pandas as pd
-import requests
 import matplotlib.pyplot as plt
 import seaborn as sns
-import geopandas as gpd
-import json
+from data_loader import get_crime_data, UpstreamUnavailable
+from aggregations import get_crime_cube, get_district_periods, CATEGORY_COLORS, PERIOD_BEFORE, PERIOD_AFTER
+from boundaries import read_merhav_boundaries, fill_geojson, FILL_TOLERANCE
+from vector_tiles import TILES_DIR, tile_sources, boundary_layers
+from anomalies import get_anomalies, trend_anomalies
 
 
 #set page config
 st.set_page_config(page_title="Crime Dashboard", layout="wide")
 
+CATEGORY_TICK_LABELS = {
+    "עבירות פליליות כלליות": "עבירות פליליות<br>כלליות",
+    "עבירות מוסר וסדר ציבורי": "עבירות מוסר<br>וסדר ציבורי",
+    "עבירות ביטחון": "עבירות<br>ביטחון",
+    "עבירות כלכליות ומנהליות": "עבירות<br>כלכליות ומנהליות",
+    "עבירות מרמה": "עבירות<br>מרמה",
+    "עבירות תנועה": "עבירות<br>תנועה"
+}
+
+# the folder Streamlit serves at app/static/ (server.enableStaticServing)
+APP_STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+
 # Helper functions
-@st.cache_data
+def fetch_crime_data():
+    """
+    Returns the shared frame of the last good snapshot, stopping the page if there is none
+    :return: pandas df of all years (shared between sessions, do not modify)
+    """
+    try:
+        df, status = get_crime_data()
+    except UpstreamUnavailable:
+        st.error("לא ניתן לטעון את הנתונים מ-data.gov.il כרגע. נסו שוב בעוד מספר דקות.")
+        st.stop()
+    display_data_status(status)
+    return df
+
 def load_data():
-    urls = {
-        "2020": "https://data.gov.il/api/3/action/datastore_search?resource_id=520597e3-6003-4247-9634-0ae85434b971",
-        "2021": "https://data.gov.il/api/3/action/datastore_search?resource_id=3f71fd16-25b8-4cfe-8661-e6199db3eb12",
-        "2022": "https://data.gov.il/api/3/action/datastore_search?resource_id=a59f3e9e-a7fe-4375-97d0-76cea68382c1",
-        "2023": "https://data.gov.il/api/3/action/datastore_search?resource_id=32aacfc9-3524-4fba-a282-3af052380244",
-        "2024": "https://data.gov.il/api/3/action/datastore_search?resource_id=5fc13c50-b6f3-4712-b831-a75e0f91a17e",
-    }
-    data_frames = []
-    for year, url in urls.items():
-        response = requests.get(url)
-        data = response.json()
-        records = data['result']['records']
-        df = pd.DataFrame(records)
-        df['Year'] = int(year)  # Add year column
-        df["Category"] = df["StatisticGroup"].apply(categorize_statistic_group)
-        df = df.dropna(subset=["Category"])
-        df["ReversedStatisticGroup"] = df["Category"].apply(lambda x: x[::-1])
-        data_frames.append(df)
-    return pd.concat(data_frames, ignore_index=True)
-
-def categorize_statistic_group(stat_group):
-    """
-    Divides the statistic groups into 6
-    :param stat_group: the initial statistic group
-    :return: one of the 6 groups it belongs to
-    """
-    categories = {
-        "עבירות פליליות כלליות": ['עבירות כלפי הרכוש', 'עבירות נגד גוף', 'עבירות נגד אדם', 'עבירות מין'],
-        "עבירות מוסר וסדר ציבורי": ['עבירות כלפי המוסר', 'עבירות סדר ציבורי'],
-        "עבירות ביטחון": ['עבירות בטחון'],
-        "עבירות כלכליות ומנהליות": ['עבירות כלכליות', 'עבירות מנהליות', 'עבירות רשוי'],
-        "עבירות תנועה": ['עבירות תנועה'],
-        "עבירות מרמה": ['עבירות מרמה']
-    }
-    for category, types in categories.items():
-        if stat_group in types:
-            return category
-    return None
+    """
+    Loads the crime records of all years from the last good snapshot
+    :return: pandas df of all years (a copy, pages may modify it freely)
+    """
+    return fetch_crime_data().copy()
 
-def preprocess_data_district(df):
+def load_aggregates():
     """
-    preprocessed the districts names
-    :param df: out data frame
-    :return: pandas df with the district names preprocessed
+    Loads the precomputed merhav x category x quarter aggregates
+    :return: CrimeCube, built once per data snapshot
     """
-    # remove nan values
-    filtered_df = df[~df["PoliceDistrict"].isin(["כל הארץ", ""])]
+    return get_crime_cube(fetch_crime_data())
 
-    # make a joined district
-    aggregated_df = filtered_df.groupby(["Category", "Period"]).agg({"Count": "sum"}).reset_index()
-    aggregated_df["PoliceDistrict"] = "כל המחוזות"
-    combined_df = pd.concat([filtered_df, aggregated_df], ignore_index=True)
+def load_anomalies():
+    """
+    Loads the unusual merhav x StatisticGroup x quarter counts of the data.gov.il records
+    Unlike fetch_crime_data, it does not stop the page, so that pages drawn from
+    other sources can show without them.
+    :return: pandas df ranked by robust z-score, detected once per data snapshot (shared, do not modify)
+    :raises UpstreamUnavailable: if there is no data snapshot at all
+    """
+    df, status = get_crime_data()
+    display_data_status(status)
+    return get_anomalies(df)
 
-    return combined_df
+def display_data_status(status):
+    """
+    Shows a staleness badge in the sidebar when the data is served from an old snapshot
+    :param status: the DataStatus returned by get_crime_data
+    """
+    if not status.is_degraded:
+        data_status_badge.empty()
+        return
+    lines = status.summary()
+    data_status_badge.markdown(
+        f"""
+        <div style="direction: rtl; text-align: right; background-color: #fff3cd; color: #856404;
+                    border-radius: 6px; padding: 6px 10px; font-size: 14px;">
+        {"<br>".join(lines)}
+        </div>
+        """,
+        unsafe_allow_html=True
+    )
 
-def extract_zip():
-    # נתיב לקובץ ה-ZIP שהועלה
-    zip_path = "policestationboundaries.gdb.zip"
+def build_districts_comparison_figure(grouped):
+    """
+    Builds the before/after bars of every district as small multiples
+    All the districts are aggregated and pivoted in a single pass and share their axes.
+    :param grouped: the normalized counts per category, period and district
+    :return: plotly figure with one facet per district
+    """
+    per_district = grouped[grouped["PoliceDistrict"] != "כל המחוזות"]
+    pivot_df = (
+        per_district.pivot_table(
+            index=["PoliceDistrict", "Category"],
+            columns="Period",
+            values="NormalizedCount",
+            aggfunc="sum",
+            fill_value=0
+        )
+        .reindex(columns=[PERIOD_BEFORE, PERIOD_AFTER], fill_value=0)
+        .reset_index()
+    )
 
-    # חלץ את התוכן לתוך קולאב
-    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-        zip_ref.extractall("PoliceStationBoundaries")
+    # Same category order in every facet, by the national pre-7.10 volume
+    category_order = (
+        pivot_df.groupby("Category")[PERIOD_BEFORE].sum().sort_values(ascending=False).index.tolist()
+    )
+    district_order = sorted(pivot_df["PoliceDistrict"].unique())
 
-    # ודא שהתיקייה קיימת
-    gdb_path = "PoliceStationBoundaries/PoliceStationBoundaries.gdb"
-    return gdb_path
+    fig = px.bar(
+        pivot_df,
+        x="Category",
+        y=[PERIOD_BEFORE, PERIOD_AFTER],
+        barmode="group",
+        facet_col="PoliceDistrict",
+        facet_col_wrap=3,
+        facet_row_spacing=0.12,
+        category_orders={"Category": category_order, "PoliceDistrict": district_order},
+        labels={"value": "כמות עבירות מנורמלת לרבעון", "variable": "", "Category": ""}
+    )
+    fig.for_each_annotation(lambda annotation: annotation.update(
+        text=annotation.text.split("=")[-1], font=dict(size=18)
+    ))
+    fig.update_xaxes(
+        tickmode="array",
+        tickvals=category_order,
+        ticktext=[CATEGORY_TICK_LABELS[category] for category in category_order]
+    )
+    fig.update_yaxes(gridcolor="lightgrey", gridwidth=0.5)
+    fig.update_layout(
+        legend_title="",
+        plot_bgcolor="#f9f9f9",
+        height=350 * ((len(district_order) + 2) // 3)
+    )
+    return fig
+
+def build_quarterly_animation_figure(gdf, df, tiles):
+    """
+    Builds a choropleth animation that steps through every quarter
+    The counts come from a single merhav x quarter matrix, and the boundaries are
+    attached once to the base trace: the frames only carry the color values.
+    :param gdf: the merhav boundaries, with the MerhavName column
+    :param df: the (crime type filtered) records, with the PoliceMerhav, Year and Quarter columns
+    :param tiles: the boundary_tile_sources
+    :return: plotly figure with one frame per quarter
+    """
+    year_quarter = df["Year"].astype(str) + "-Q" + df["Quarter"].astype(str).str.extract(r"(\d)", expand=False)
+    matrix = (
+        pd.crosstab(df["PoliceMerhav"], year_quarter)
+        .reindex(index=gdf["MerhavName"], fill_value=0)
+    )
+    quarters = sorted(matrix.columns)
+    z_max = matrix.to_numpy().max() if matrix.size else 0
+
+    fig = go.Figure(
+        data=[go.Choroplethmap(
+            geojson=load_merhav_geojson(tiles is not None),
+            featureidkey="properties.MerhavName",
+            locations=gdf["MerhavName"],
+            z=matrix[quarters[0]].to_numpy() if quarters else [],
+            hovertemplate="<b>%{location}</b><br>מספר עבירות: %{z}<extra></extra>",
+            marker_line_width=fill_line_width(tiles),
+            colorscale="Reds",
+            reversescale=True,
+            zmin=0,
+            zmax=z_max,
+            colorbar=dict(title="מספר עבירות")
+        )],
+        frames=[
+            go.Frame(name=quarter, data=[go.Choroplethmap(z=matrix[quarter].to_numpy())])
+            for quarter in quarters
+        ]
+    )
+
+    fig.update_layout(
+        annotations=[
+            dict(
+                text="2020-2024 מפת עבירות לפי רבעונים",
+                x=1,
+                y=1.1,
+                xref="paper",
+                yref="paper",
+                showarrow=False,
+                font=dict(size=24, color="black"),
+                align="right"
+            )
+        ],
+        map=boundary_map(tiles),
+        height=800,
+        width=500,
+        margin=dict(l=20, r=20, t=80, b=20),
+        updatemenus=[dict(
+            type="buttons",
+            direction="left",
+            x=0,
+            y=0,
+            xanchor="left",
+            yanchor="top",
+            pad=dict(t=40),
+            buttons=[
+                dict(label="▶", method="animate",
+                     args=[None, dict(frame=dict(duration=700, redraw=True), fromcurrent=True)]),
+                dict(label="❚❚", method="animate",
+                     args=[[None], dict(frame=dict(duration=0, redraw=False), mode="immediate")])
+            ]
+        )],
+        sliders=[dict(
+            active=0,
+            x=0.1,
+            len=0.9,
+            y=0,
+            currentvalue=dict(prefix="רבעון: "),
+            steps=[
+                dict(label=quarter, method="animate",
+                     args=[[quarter], dict(frame=dict(duration=0, redraw=True), mode="immediate")])
+                for quarter in quarters
+            ]
+        )]
+    )
+    return fig
+
+@st.cache_data
+def load_merhav_boundaries():
+    """
+    Loads the police merhav boundaries, reprojected to WGS84
+    :return: GeoDataFrame with the MerhavName, centroid and unique_id columns
+    """
+    return read_merhav_boundaries()
+
+def boundary_tiles_url():
+    """
+    The URL the browsers load the boundary vector tiles from: CRIME_TILES_URL, or the
+    dashboard's own origin when the tiles were built under the served static folder
+    :return: the base URL of the tiles, or None if the browsers cannot reach them
+    """
+    if os.environ.get("CRIME_TILES_URL"):
+        return os.environ["CRIME_TILES_URL"]
+    tiles_path = os.path.relpath(os.path.abspath(TILES_DIR), APP_STATIC_DIR)
+    if not st.get_option("server.enableStaticServing") or tiles_path.startswith(".."):
+        return None
+    # absolute, as MapLibre loads the tiles from a worker that cannot resolve relative URLs
+    app_url = urlsplit(st.context.url or "")
+    if not app_url.netloc:
+        return None
+    base_path = st.get_option("server.baseUrlPath").strip("/")
+    prefix = f"/{base_path}" if base_path else ""
+    return f"{app_url.scheme}://{app_url.netloc}{prefix}/app/static/{tiles_path.replace(os.sep, '/')}"
+
+def boundary_tile_sources():
+    """
+    :return: the vector sources of the boundary tiles (python vector_tiles.py build),
+             or None to draw the boundaries from the GeoJSON alone
+    """
+    tiles_url = boundary_tiles_url()
+    return tile_sources(tiles_url, inline=True) if tiles_url else None
+
+@st.cache_resource
+def load_merhav_geojson(simplified):
+    """
+    The merhav boundaries for the choropleth fill. When the detailed outlines
+    come from the vector tiles, the fill only needs a geometry simplified to a
+    pixel at the deepest zoom of the tiles.
+    :param simplified: whether the vector tiles draw the outlines
+    :return: GeoJSON dict keyed by properties.MerhavName (read only)
+    """
+    tolerance = FILL_TOLERANCE if simplified else 0
+    return fill_geojson(load_merhav_boundaries(), "MerhavName", tolerance)
+
+def fill_line_width(tiles):
+    """
+    :param tiles: the boundary_tile_sources
+    :return: the outline width of the choropleth fill, hidden when the tiles draw the outlines
+    """
+    return 0 if tiles else 1
+
+def boundary_map(tiles, zoom=6.2):
+    """
+    :param tiles: the boundary_tile_sources
+    :param zoom: the initial zoom
+    :return: the map layout of the maps, centered on Israel, with the tile outlines when available
+    """
+    return dict(
+        center={"lat": 31.5, "lon": 34.8},
+        zoom=zoom,
+        style="carto-positron",
+        layers=boundary_layers(tiles) if tiles else []
+    )
+
+@st.cache_resource(max_entries=64)
+def build_linked_map_figure(_cube, category, cube_key, tiles):
+    """
+    Builds the merhav map of the linked page
+    :param _cube: the CrimeCube (not hashed, `cube_key` identifies its content)
+    :param category: color by this category (None for all)
+    :param cube_key: _cube.category_key(category)
+    :param tiles: the boundary_tile_sources (they differ by the origin the page was opened from)
+    :return: plotly figure
+    """
+    gdf = load_merhav_boundaries()
+    merhav_totals = _cube.merhav_totals(category).reindex(gdf["MerhavName"], fill_value=0)
+    fig = go.Figure(go.Choroplethmap(
+        geojson=load_merhav_geojson(tiles is not None),
+        featureidkey="properties.MerhavName",
+        locations=gdf["MerhavName"],
+        z=merhav_totals.to_numpy(),
+        colorscale="Reds",
+        reversescale=True,
+        hovertemplate="<b>%{location}</b><br>מספר עבירות: %{z}<extra></extra>",
+        marker_line_width=fill_line_width(tiles),
+        colorbar=dict(title="מספר עבירות")
+    ))
+    fig.update_layout(
+        title=dict(
+            text=f"מפת עבירות - {category}" if category else "מפת עבירות - כל סוגי העבירות",
+            x=1,
+            xanchor="right"
+        ),
+        map=boundary_map(tiles),
+        height=800,
+        margin=dict(l=20, r=20, t=60, b=20)
+    )
+    return fig
+
+@st.cache_resource(max_entries=256)
+def build_linked_trend_figure(_cube, merhav, category, cube_key):
+    """
+    Builds the trend lines of the linked page
+    :param _cube: the CrimeCube (not hashed, `cube_key` identifies its content)
+    :param merhav: restrict to this merhav (None for the whole country)
+    :param category: highlight this category (None for none)
+    :param cube_key: _cube.merhav_key(merhav)
+    :return: plotly figure
+    """
+    fig = px.line(
+        _cube.trend(merhav),
+        x="YearQuarter",
+        y="Count",
+        color="Category",
+        color_discrete_map=CATEGORY_COLORS,
+        labels={"YearQuarter": "רבעון", "Count": "מספר עבירות", "Category": ""}
+    )
+    if category:
+        fig.for_each_trace(lambda trace: trace.update(opacity=1 if trace.name == category else 0.25))
+    add_trend_anomaly_markers(fig, trend_anomalies(_cube, merhav))
+    if "2023-Q4" in _cube.quarters:
+        fig.add_vline(x="2023-Q4", line_dash="dash", line_color="gray")
+    fig.update_layout(
+        title=dict(text=f"מגמות פשיעה - {merhav or 'כל הארץ'}", x=1, xanchor="right"),
+        plot_bgcolor="#f9f9f9",
+        xaxis=dict(categoryorder="array", categoryarray=_cube.quarters),
+        height=380
+    )
+    return fig
+
+@st.cache_resource(max_entries=64)
+def build_linked_bars_figure(_cube, merhav, cube_key):
+    """
+    Builds the before/after 7.10 bars of the linked page
+    :param _cube: the CrimeCube (not hashed, `cube_key` identifies its content)
+    :param merhav: restrict to this merhav (None for the whole country)
+    :param cube_key: _cube.merhav_key(merhav)
+    :return: plotly figure
+    """
+    before_after_df = _cube.before_after(merhav).sort_values(PERIOD_BEFORE, ascending=False)
+    fig = px.bar(
+        before_after_df,
+        x="Category",
+        y=[PERIOD_BEFORE, PERIOD_AFTER],
+        barmode="group",
+        labels={"value": "כמות עבירות מנורמלת לרבעון", "variable": "", "Category": ""}
+    )
+    fig.update_layout(
+        title=dict(text=f"לפני ואחרי ה-7.10 - {merhav or 'כל הארץ'}", x=1, xanchor="right"),
+        plot_bgcolor="#f9f9f9",
+        xaxis=dict(
+            tickmode="array",
+            tickvals=before_after_df["Category"].tolist(),
+            ticktext=[CATEGORY_TICK_LABELS.get(category, category) for category in before_after_df["Category"]]
+        ),
+        height=380
+    )
+    return fig
+
+def add_trend_anomaly_markers(fig, anomalies_df):
+    """
+    Circles the unusual points of a trend chart
+    :param fig: the trend figure, with YearQuarter on the x axis
+    :param anomalies_df: the points to circle, as returned by trend_anomalies
+    """
+    if anomalies_df.empty:
+        return
+    fig.add_trace(go.Scatter(
+        x=anomalies_df["YearQuarter"],
+        y=anomalies_df["Count"],
+        mode="markers",
+        marker=dict(symbol="circle-open", size=16, color="black", line=dict(width=2)),
+        name="חריגה",
+        customdata=anomalies_df[["Category", "Baseline", "ZScore"]],
+        hovertemplate="<b>%{customdata[0]}</b><br>%{x}: %{y} עבירות<br>"
+                      "צפוי: %{customdata[1]:.0f} (z=%{customdata[2]})<extra>חריגה</extra>"
+    ))
+
+def add_map_anomaly_markers(fig, gdf, anomalies_df):
+    """
+    Marks the merhavim with unusual counts on a choropleth, at their centroids
+    The anomalies come from the data.gov.il records, which may differ from the
+    source of the choropleth, so the markers say so.
+    :param fig: the merhav choropleth
+    :param gdf: the merhav boundaries, with the MerhavName and centroid columns
+    :param anomalies_df: the anomalies to mark, as returned by get_anomalies
+    """
+    if anomalies_df.empty:
+        return
+    per_merhav = (
+        anomalies_df.assign(Line=anomalies_df["YearQuarter"] + " " + anomalies_df["StatisticGroup"]
+                            + ": " + anomalies_df["Count"].astype(str)
+                            + " (צפוי " + anomalies_df["Baseline"].round().astype(int).astype(str) + ")")
+        .groupby("PoliceMerhav")
+        .agg(Anomalies=("Line", "size"), Lines=("Line", lambda lines: "<br>".join(lines.head(5))))
+        .join(gdf.set_index("MerhavName")[["centroid_lat", "centroid_lon"]], how="inner")
+    )
+    fig.add_trace(go.Scattermap(
+        lat=per_merhav["centroid_lat"],
+        lon=per_merhav["centroid_lon"],
+        mode="markers",
+        marker=dict(size=(10 + 4 * per_merhav["Anomalies"]).clip(upper=30), color="#1565c0", opacity=0.8),
+        text=per_merhav.index,
+        customdata=per_merhav[["Anomalies", "Lines"]],
+        hovertemplate="<b>%{text}</b><br>%{customdata[0]} חריגות<br>%{customdata[1]}"
+                      "<br><i>לפי נתוני data.gov.il העדכניים</i><extra></extra>",
+        name="חריגות (data.gov.il)",
+        showlegend=False
+    ))
+
+def remember_selection(chart_key, field, state_key):
+    """
+    on_select callback storing the value clicked on a chart in the session state
+    A chart whose figure changed gets a new widget and loses its selection
+    without any event, so the pages draw from the stored value instead, which
+    only an explicit deselect (a double click) clears.
+    :param chart_key: the key the chart was drawn with
+    :param field: the field of the selected point to store (e.g. "x", "location")
+    :param state_key: where to store it in st.session_state
+    """
+    event = st.session_state.get(chart_key)
+    points = event["selection"]["points"] if event else []
+    if points:
+        st.session_state[state_key] = points[0].get(field)
+    else:
+        st.session_state.pop(state_key, None)
 
 def display_crime_categories():
     st.markdown("""
@@ -137,9 +510,11 @@ menu_option = st.sidebar.radio(
     [
         "נתוני הפשיעה במבט על",
         "התפלגות סוגי עבירות לפי מרחבים משטרתיים",
-        "השפעות מאורעות ה-7.10.2023 על התפלגות הפשיעה בישראל"
+        "השפעות מאורעות ה-7.10.2023 על התפלגות הפשיעה בישראל",
+        "ניתוח מקושר: מרחבים, מגמות ו-7.10"
     ]
 )
+data_status_badge = st.sidebar.empty()
 
 # Inject custom CSS to align the sidebar content
 st.markdown("""
@@ -337,15 +712,9 @@ if menu_option == 'נתוני הפשיעה במבט על':
      ### מגמות פשיעה לאורך זמן
      .הגרף מציג את מגמות הפשיעה לאורך זמן בחלוקה לפי רבעונים. ניתן לסנן את סוגי העבירות בעזרת התיבות בצד ימין
      """, unsafe_allow_html=True)
-    df = load_data()
-
-    # Preprocess Data
-    df['Category'] = df['StatisticGroup'].apply(categorize_statistic_group)
-    df = df.dropna(subset=['Year', 'Category'])
-    df['Year'] = df['Year'].astype(int)
-    df['Quarter'] = df['Quarter'].str.extract(r'(‎?\d)').fillna('1').astype(int)
-    df = df[df['Quarter'].isin([1, 2, 3, 4])]  # Ensure valid quarters
-    df['YearQuarter'] = df['Year'].astype(str) + '-Q' + df['Quarter'].astype(str)
+    # Category and YearQuarter are derived once per fetched record by the data loader
+    df = fetch_crime_data()
+    df = df[df['QuarterNumber'].isin([1, 2, 3, 4])]  # Ensure valid quarters
 
     # Layout with columns
     col1, col2 = st.columns([4, 1], gap="medium")  # Adjust ratio to prioritize graph width
@@ -377,15 +746,6 @@ if menu_option == 'נתוני הפשיעה במבט על':
         unique_quarters = sorted(df['YearQuarter'].unique())
         agg_df['YearQuarter'] = pd.Categorical(agg_df['YearQuarter'], categories=unique_quarters, ordered=True)
 
-        color_map = {
-            "עבירות פליליות כלליות": "#1f77b4",  # Blue
-            "עבירות מוסר וסדר ציבורי": "#ff7f0e",  # Orange
-            "עבירות ביטחון": "#2ca02c",  # Green
-            "עבירות כלכליות ומנהליות": "#d62728",  # Red
-            "עבירות תנועה": "#9467bd",  # Purple
-            "עבירות מרמה": "#8c564b"  # Brown
-        }
-
         fig = px.line(
             agg_df,
             x='YearQuarter',
@@ -400,7 +760,13 @@ if menu_option == 'נתוני הפשיעה במבט על':
         )
 
         # Apply fixed colors
-        fig.for_each_trace(lambda trace: trace.update(line_color=color_map[trace.name]))
+        fig.for_each_trace(lambda trace: trace.update(line_color=CATEGORY_COLORS[trace.name]))
+
+        # Circle the quarters that stand out from the same quarter in other years
+        trend_anomalies_df = trend_anomalies(load_aggregates())
+        add_trend_anomaly_markers(
+            fig, trend_anomalies_df[trend_anomalies_df["Category"].isin(selected_crime_types)]
+        )
 
         # Find the index of "2023-Q4" in the unique_quarters list
         q4_index = unique_quarters.index("2023-Q4") if "2023-Q4" in unique_quarters else None
@@ -451,34 +817,11 @@ if menu_option == 'נתוני הפשיעה במבט על':
 
 
 elif menu_option == 'השפעות מאורעות ה-7.10.2023 על התפלגות הפשיעה בישראל':
-    # Load and process data
-    df = load_data()  # Ensure this function is defined and loads the correct dataset
-    df["Quarter"] = df["Quarter"].str.extract(r"(\d)").astype(float)
-    df["Period"] = "לפני ה7.10"
-    df.loc[(df["Year"] == 2023) & (df["Quarter"] > 3), "Period"] = "אחרי ה7.10"
-    df.loc[df["Year"] == 2024, "Period"] = "אחרי ה7.10"
-
-    # Categorize statistic groups
-    df["Category"] = df["StatisticGroup"].apply(categorize_statistic_group)
+    # Load data (Category and Period are derived once per fetched record by the data loader)
+    df = fetch_crime_data()
 
-    # Drop rows where Category is None (uncategorized values)
-    df = df.dropna(subset=["Category"])
-
-    # Group by necessary fields
-    grouped = df.groupby(["Category", "Period", "PoliceDistrict"]).size().reset_index(name="Count")
-
-    # Apply preprocessing
-    grouped = preprocess_data_district(grouped)
-
-    # Normalize by quarter count
-    quarters_before = (2023 - 2020) * 4 + 3  # First quarter of 2020 to third quarter of 2023
-    quarters_after = 5  # Fourth quarter of 2023 to fourth quarter of 2024
-
-    grouped["NormalizedCount"] = grouped.apply(
-        lambda row: round(row["Count"] / quarters_before) if row["Period"] == "לפני ה7.10"
-        else round(row["Count"] / quarters_after),
-        axis=1
-    )
+    # Counts per category, period and district, normalized by quarter count (shared with the Dash app)
+    grouped = get_district_periods(df)
 
     # Define districts
     districts = sorted(
@@ -541,108 +884,106 @@ elif menu_option == 'השפעות מאורעות ה-7.10.2023 על התפלגו
             </div>
         """, unsafe_allow_html=True)
 
+        show_all_districts = st.checkbox("השוואה בין כל המחוזות", key="districts-small-multiples")
+
         # Dropdown menu
         selected_district = st.selectbox(
             "",
             districts,  # List of districts
             index=0,  # Default to "כל המחוזות"
-            key="district-selector"
+            key="district-selector",
+            disabled=show_all_districts
         )
 
-    # Filter data based on selected district
-    if selected_district == "כל המחוזות":
-        filtered_df = grouped
+    if show_all_districts:
+        # Small multiples: every district in one faceted figure
+        st.plotly_chart(build_districts_comparison_figure(grouped), use_container_width=True)
     else:
-        filtered_df = grouped[grouped["PoliceDistrict"] == selected_district]
-
-    # Aggregate data
-    aggregated_df = filtered_df.groupby(["Category", "Period"], as_index=False)["NormalizedCount"].sum()
-
-    # Pivot the aggregated data
-    pivot_df = (
-        aggregated_df.pivot(index="Category", columns="Period", values="NormalizedCount")
-        .fillna(0)  # Fill missing values with 0
-        .reset_index()
-    )
+        # Filter data based on selected district
+        if selected_district == "כל המחוזות":
+            filtered_df = grouped
+        else:
+            filtered_df = grouped[grouped["PoliceDistrict"] == selected_district]
 
-    # Adjust Y-axis based on selected district
-    if selected_district == "כל המחוזות":
-        y_tick_interval = 500
-        y_max = 4000
-    else:
-        y_tick_interval = 100
-        y_max = 1000
+        # Aggregate data
+        aggregated_df = filtered_df.groupby(["Category", "Period"], as_index=False)["NormalizedCount"].sum()
 
-    # Generate bar chart
-    pivot_df = pivot_df.sort_values(by=["לפני ה7.10", "אחרי ה7.10"], ascending=False)
+        # Pivot the aggregated data
+        pivot_df = (
+            aggregated_df.pivot(index="Category", columns="Period", values="NormalizedCount")
+            .fillna(0)  # Fill missing values with 0
+            .reset_index()
+        )
 
-    fig = px.bar(
-        pivot_df,
-        x="Category",
-        y=["לפני ה7.10", "אחרי ה7.10"],
-        barmode="group",
-        labels={"value": "כמות עבירות מנורמלת לרבעון", "variable": "", "Category": "קטגוריה"},  # הורדת המילה "תקופה"
-        title=f"פשיעה ב{selected_district}"  # Update title to "פשיעה ב"
-    ).update_layout(
-        xaxis_title="סוגי עבירות",
-        yaxis_title="כמות עבירות מנורמלת לרבעון",
-        legend_title="",  # הסרת כותרת האגדה
-        plot_bgcolor="#f9f9f9",
-        title=dict(
-            text=f"פשיעה ב{selected_district}",  # Update title to "פשיעה ב"
-            x=1,  # Align title to the right
-            xanchor="right",  # Anchor title to the right
-            font=dict(size=28)  # Adjust title font size
-        ),
-        xaxis=dict(
-            tickmode="array",
-            tickvals=pivot_df["Category"].tolist(),
-            ticktext=[
-                "עבירות פליליות<br>כלליות",
-                "עבירות מוסר<br>וסדר ציבורי",
-                "עבירות<br>ביטחון",
-                "עבירות<br>כלכליות ומנהליות",
-                "עבירות<br>מרמה",
-                "עבירות<br>תנועה"
-            ],
-            tickfont=dict(size=18),  # גודל הטקסט של הקטגוריות בציר X
-            title_font=dict(size=20)  # גודל הטקסט של כותרת ציר X
-        ),
-        yaxis=dict(
-            tickfont=dict(size=18),  # גודל הטקסט של המספרים בציר Y
-            title_font=dict(size=20),  # גודל הטקסט של כותרת ציר Y
-            gridcolor="lightgrey",  # צבע קווים חלש יותר
-            gridwidth=0.5  # עובי קווים דק יותר
-        ),
-        legend=dict(
-            font=dict(size=18)  # גודל הטקסט של האגדה (legend)
-        ),
-        height=700  # Increase height for better visualization
-    )
+        # Adjust Y-axis based on selected district
+        if selected_district == "כל המחוזות":
+            y_tick_interval = 500
+            y_max = 4000
+        else:
+            y_tick_interval = 100
+            y_max = 1000
+
+        # Generate bar chart
+        pivot_df = pivot_df.sort_values(by=["לפני ה7.10", "אחרי ה7.10"], ascending=False)
+
+        fig = px.bar(
+            pivot_df,
+            x="Category",
+            y=["לפני ה7.10", "אחרי ה7.10"],
+            barmode="group",
+            labels={"value": "כמות עבירות מנורמלת לרבעון", "variable": "", "Category": "קטגוריה"},  # הורדת המילה "תקופה"
+            title=f"פשיעה ב{selected_district}"  # Update title to "פשיעה ב"
+        ).update_layout(
+            xaxis_title="סוגי עבירות",
+            yaxis_title="כמות עבירות מנורמלת לרבעון",
+            legend_title="",  # הסרת כותרת האגדה
+            plot_bgcolor="#f9f9f9",
+            title=dict(
+                text=f"פשיעה ב{selected_district}",  # Update title to "פשיעה ב"
+                x=1,  # Align title to the right
+                xanchor="right",  # Anchor title to the right
+                font=dict(size=28)  # Adjust title font size
+            ),
+            xaxis=dict(
+                tickmode="array",
+                tickvals=pivot_df["Category"].tolist(),
+                ticktext=[
+                    "עבירות פליליות<br>כלליות",
+                    "עבירות מוסר<br>וסדר ציבורי",
+                    "עבירות<br>ביטחון",
+                    "עבירות<br>כלכליות ומנהליות",
+                    "עבירות<br>מרמה",
+                    "עבירות<br>תנועה"
+                ],
+                tickfont=dict(size=18),  # גודל הטקסט של הקטגוריות בציר X
+                title_font=dict(size=20)  # גודל הטקסט של כותרת ציר X
+            ),
+            yaxis=dict(
+                tickfont=dict(size=18),  # גודל הטקסט של המספרים בציר Y
+                title_font=dict(size=20),  # גודל הטקסט של כותרת ציר Y
+                gridcolor="lightgrey",  # צבע קווים חלש יותר
+                gridwidth=0.5  # עובי קווים דק יותר
+            ),
+            legend=dict(
+                font=dict(size=18)  # גודל הטקסט של האגדה (legend)
+            ),
+            height=700  # Increase height for better visualization
+        )
 
-    # Display bar chart
-    st.plotly_chart(fig, use_container_width=True)
+        # Display bar chart
+        st.plotly_chart(fig, use_container_width=True)
 
 elif menu_option == 'התפלגות סוגי עבירות לפי מרחבים משטרתיים':
-    gdb_path = extract_zip()
     df_all = pd.read_csv('clean_df_heatmap.csv')
-    layer_name = "PoliceMerhavBoundaries"
-    gdf = gpd.read_file(gdb_path, layer=layer_name)
-
-    # Convert GeoDataFrame to GeoJSON and reproject to WGS84
-    gdf = gdf.to_crs(epsg=4326)
-    gdf['MerhavName'] = gdf['MerhavName'].str.strip().str.replace(r'\r\n', '', regex=True)
+    gdf = load_merhav_boundaries()
     df_all['PoliceMerhav'] = df_all['PoliceMerhav'].str.strip().str.replace(r'\r\n', '', regex=True)
 
     gdf['record_count'] = 0  # Initialize record count for mapping
-    gdf['centroid_lat'] = gdf.geometry.centroid.y
-    gdf['centroid_lon'] = gdf.geometry.centroid.x
 
     # Sort and prepare dropdown options
     sorted_crimes = ['כל סוגי העבירות'] + sorted(df_all['StatisticGroup'].unique())
     sorted_merhavim = ['כל המרחבים'] + sorted(gdf['MerhavName'].unique())
     years = ['לאורך כל השנים', 2020, 2021, 2022, 2023, 2024]
-    gdf['unique_id'] = gdf.index
 
     st.markdown(
         """
@@ -699,7 +1040,8 @@ elif menu_option == 'התפלגות סוגי עבירות לפי מרחבים מ
 
     # Dropdowns for user selection
     selected_crime = st.selectbox("בחר סוג עבירה:", options=sorted_crimes)
-    selected_year = st.selectbox("בחר שנה:", options=years)
+    animate_quarters = st.checkbox("הנפשה לאורך כל הרבעונים")
+    selected_year = st.selectbox("בחר שנה:", options=years, disabled=animate_quarters)
 
     # Filter data based on selections
     if selected_crime == 'כל סוגי העבירות':
@@ -707,63 +1049,147 @@ elif menu_option == 'התפלגות סוגי עבירות לפי מרחבים מ
     else:
         filtered_df = df_all[df_all['StatisticGroup'] == selected_crime]
 
-    if selected_year != 'לאורך כל השנים':
+    if selected_year != 'לאורך כל השנים' and not animate_quarters:
         filtered_df = filtered_df[filtered_df['Year'] == int(selected_year)]
 
-    # Summarize counts by Merhav
-    merhav_counts = filtered_df['PoliceMerhav'].value_counts()
-    gdf['record_count'] = gdf['MerhavName'].map(merhav_counts).fillna(0)
-
-    fig = px.choropleth_mapbox(
-        gdf,
-        geojson=json.loads(gdf.to_json()),
-        locations='unique_id',
-        color="record_count",
-        hover_name="MerhavName",
-        hover_data={"record_count": True, 'unique_id': False},  # Exclude "unique_id" from tooltips
-        mapbox_style="carto-positron",
-        center={"lat": 31.5, "lon": 34.8},  # Centered on Israel
-        zoom=6.3,  # Adjusted zoom level to fit Israel
-        color_continuous_scale="Reds",
-        title=f"{selected_year} מפת עבירות" if selected_year != 'לאורך כל השנים' else "2020-2024 מפת עבירות",
-        labels={"record_count": "מספר עבירות"}
-    )
+    # Unusual counts for the same selection, from the live records rather than the
+    # file of the map; the map is drawn without them when those are unavailable
+    try:
+        anomalies_df = load_anomalies()
+    except UpstreamUnavailable:
+        anomalies_df = None
+    if anomalies_df is not None and selected_crime != 'כל סוגי העבירות':
+        anomalies_df = anomalies_df[anomalies_df['StatisticGroup'] == selected_crime]
+    if anomalies_df is not None and selected_year != 'לאורך כל השנים' and not animate_quarters:
+        anomalies_df = anomalies_df[anomalies_df['YearQuarter'].str.startswith(f"{selected_year}-")]
+
+    tiles = boundary_tile_sources()
+    if animate_quarters:
+        fig = build_quarterly_animation_figure(gdf, filtered_df, tiles)
+    else:
+        # Summarize counts by Merhav
+        merhav_counts = filtered_df['PoliceMerhav'].value_counts()
+        gdf['record_count'] = gdf['MerhavName'].map(merhav_counts).fillna(0)
+
+        fig = px.choropleth_map(
+            gdf,
+            geojson=load_merhav_geojson(tiles is not None),
+            featureidkey="properties.MerhavName",
+            locations="MerhavName",
+            color="record_count",
+            hover_name="MerhavName",
+            hover_data={"record_count": True, "MerhavName": False},
+            map_style="carto-positron",
+            center={"lat": 31.5, "lon": 34.8},  # Centered on Israel
+            zoom=6.3,  # Adjusted zoom level to fit Israel
+            color_continuous_scale="Reds",
+            title=f"{selected_year} מפת עבירות" if selected_year != 'לאורך כל השנים' else "2020-2024 מפת עבירות",
+            labels={"record_count": "מספר עבירות"}
+        )
 
-    fig.update_traces(
-        reversescale=True  # Set to True if you want to reverse light-to-dark order
-    )
+        fig.update_traces(
+            reversescale=True,  # Set to True if you want to reverse light-to-dark order
+            marker_line_width=fill_line_width(tiles)
+        )
 
-    # Update layout for vertical orientation
-    fig.update_layout(
-        annotations=[
-            dict(
-                text=f"{selected_year} מפת עבירות" if selected_year != 'לאורך כל השנים' else "2020-2024 מפת עבירות",
-                x=1,  # Align to the far right
-                y=1.1,  # Place above the map
-                xref="paper",  # Use the figure as the reference frame
-                yref="paper",
-                showarrow=False,  # No arrow for the annotation
-                font=dict(size=24, color="black"),
-                align="right"  # Align the text to the right
+        # Update layout for vertical orientation
+        fig.update_layout(
+            annotations=[
+                dict(
+                    text=f"{selected_year} מפת עבירות" if selected_year != 'לאורך כל השנים' else "2020-2024 מפת עבירות",
+                    x=1,  # Align to the far right
+                    y=1.1,  # Place above the map
+                    xref="paper",  # Use the figure as the reference frame
+                    yref="paper",
+                    showarrow=False,  # No arrow for the annotation
+                    font=dict(size=24, color="black"),
+                    align="right"  # Align the text to the right
+                )
+            ],
+            title_text="",
+            map=boundary_map(tiles),
+            height=800,  # Taller map for vertical orientation
+            width=500,
+            title_x=0.4,
+            margin=dict(
+                l=20,  # Left margin
+                r=20,  # Right margin for better alignment
+                t=80,  # Top margin for annotation space
+                b=20  # Bottom margin
             )
-        ],
-        title_text="",
-        mapbox=dict(
-            center={"lat": 31.5, "lon": 34.8},  # Center on Israel
-            zoom=6.2,  # Zoom out slightly to show entire Israel
-            style="carto-positron"
-        ),
-        height=800,  # Taller map for vertical orientation
-        width=500,
-        title_x=0.4,
-        margin=dict(
-            l=20,  # Left margin
-            r=20,  # Right margin for better alignment
-            t=80,  # Top margin for annotation space
-            b=20  # Bottom margin
         )
-    )
+    if anomalies_df is not None:
+        # the frames of the animation only update the choropleth, the markers stay on every quarter
+        add_map_anomaly_markers(fig, gdf, anomalies_df)
     # Display the map
     st.plotly_chart(fig, use_container_width=True)
 
+    if selected_year != 'לאורך כל השנים' and not animate_quarters:
+        anomaly_quarters = f"ברבעוני שנת {selected_year}"
+    else:
+        anomaly_quarters = "בכל הרבעונים, גם בהנפשה ובלי קשר לרבעון המוצג בה"
+    st.markdown(f"""
+     <div style="text-align: right; direction: rtl; font-size: 18px; line-height: 1.6;">
+     <h3>חריגות בולטות</h3>
+     רבעונים שבהם מספר העבירות במרחב חורג באופן חריג מאותו רבעון בשנים האחרות (ציון z חסין של 3.5 ומעלה).
+     המרחבים שבהם נמצאו חריגות מסומנים במפה בעיגול כחול, והטבלה מציגה את החריגות {anomaly_quarters}.
+     החריגות מחושבות מנתוני data.gov.il העדכניים ולא מהקובץ שלפיו נצבעת המפה, ולכן המספרים בהן עשויים להיות שונים מאלה שבמפה.
+     </div>
+     """, unsafe_allow_html=True)
+    if anomalies_df is None:
+        st.info("לא ניתן לטעון כרגע את הנתונים מ-data.gov.il, ולכן החריגות אינן מוצגות.")
+    elif anomalies_df.empty:
+        st.info("לא נמצאו חריגות עבור הבחירה הנוכחית.")
+    else:
+        st.dataframe(
+            anomalies_df.rename(columns={
+                "PoliceMerhav": "מרחב",
+                "StatisticGroup": "סוג עבירה",
+                "YearQuarter": "רבעון",
+                "Count": "מספר עבירות",
+                "Baseline": "צפוי",
+                "ZScore": "ציון z"
+            }),
+            hide_index=True,
+            use_container_width=True
+        )
+
 
+elif menu_option == 'ניתוח מקושר: מרחבים, מגמות ו-7.10':
+    # Every chart below is answered from the shared aggregates, so a click only
+    # slices the precomputed cube instead of regrouping the records
+    cube = load_aggregates()
+
+    st.title("ניתוח מקושר של הפשיעה לפי מרחבים")
+    st.markdown("""
+    <div style="text-align: right; direction: rtl; font-size: 18px; line-height: 1.6;">
+    לחיצה על מרחב במפה מסננת את גרף המגמות ואת השוואת התקופות לאותו מרחב.
+    לחיצה על סוג עבירה בגרף העמודות צובעת את המפה לפי אותו סוג עבירה ומדגישה אותו בגרף המגמות.
+    לחיצה כפולה על גרף מבטלת את הבחירה בו.
+    </div>
+    """, unsafe_allow_html=True)
+
+    # The selections are kept in the session state, so every chart reflects both of
+    # them even after the chart they were made on was redrawn
+    selected_merhav = st.session_state.get("linked-merhav")
+    selected_category = st.session_state.get("linked-category")
+
+    col1, col2 = st.columns([2, 3], gap="medium")
+
+    # The figures are cached by the version of the cube slice they show, so a
+    # data refresh only rebuilds the figures whose slice actually changed
+    with col2:
+        map_fig = build_linked_map_figure(cube, selected_category, cube.category_key(selected_category),
+                                          boundary_tile_sources())
+        st.plotly_chart(map_fig, use_container_width=True,
+                        on_select=lambda: remember_selection("linked-map", "location", "linked-merhav"),
+                        selection_mode="points", key="linked-map")
+
+    with col1:
+        merhav_key = cube.merhav_key(selected_merhav)
+        st.plotly_chart(build_linked_trend_figure(cube, selected_merhav, selected_category, merhav_key),
+                        use_container_width=True)
+        st.plotly_chart(build_linked_bars_figure(cube, selected_merhav, merhav_key),
+                        use_container_width=True,
+                        on_select=lambda: remember_selection("linked-bars", "x", "linked-category"),
+                        selection_mode="points", key="linked-bars")
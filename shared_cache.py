@@ -0,0 +1,182 @@
+"""
+On-disk cache shared by all the dashboard processes of a host.
+
+Every cached frame is stored as an uncompressed Arrow (feather) file so that
+readers can memory-map it instead of parsing it. The string columns are kept
+as Arrow arrays over the mapped buffers (pd.ArrowDtype), so the page cache
+holds the text once for all the workers. Usable entries are mapped without
+locking. Rebuilding a key happens under an exclusive `flock` on the key's lock
+file: exactly one process rebuilds the entry while the others that need it
+rebuilt wait on the lock and then map the file it wrote.
+
+`manifest.json` records, per key, when the entry was fetched, a digest of its
+content and the generation in which that content first appeared. The global
+generation is bumped only when the content of some key actually changed, so
+workers can poll it cheaply and reload only what changed.
+
+The cache directory defaults to `.crime_cache` and can be moved with the
+CRIME_CACHE_DIR environment variable (e.g. to a tmpfs shared by the workers).
+"""
+import fcntl
+import json
+import os
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+import pyarrow as pa
+from pyarrow import feather
+
+CACHE_DIR = os.environ.get("CRIME_CACHE_DIR", ".crime_cache")
+MANIFEST = "manifest.json"
+
+
+def _path(name):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    return os.path.join(CACHE_DIR, name)
+
+
+@contextmanager
+def file_lock(name, shared=False):
+    """
+    Holds a blocking flock on `<CACHE_DIR>/<name>.lock` for the duration of the block
+    :param name: the name of the lock
+    :param shared: take a shared (reader) lock instead of an exclusive one
+    """
+    fd = os.open(_path(f"{name}.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+def _write_atomically(path, write):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def read_manifest():
+    """
+    :return: the manifest dict ({"generation": int, "entries": {key: entry}})
+    """
+    try:
+        with open(_path(MANIFEST), encoding="utf-8") as manifest_file:
+            return json.load(manifest_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {"generation": 0, "entries": {}}
+
+
+def _update_manifest(key, **values):
+    """Merges `values` into the entry of `key`, bumping the generation if its digest changed."""
+    with file_lock("manifest"):
+        manifest = read_manifest()
+        entry = manifest["entries"].setdefault(key, {})
+        if "digest" in values and values["digest"] != entry.get("digest"):
+            manifest["generation"] += 1
+            values["generation"] = manifest["generation"]
+        entry.update(values)
+
+        def write(path):
+            with open(path, "w", encoding="utf-8") as manifest_file:
+                json.dump(manifest, manifest_file)
+
+        _write_atomically(_path(MANIFEST), write)
+        return dict(entry)
+
+
+def frame_digest(df):
+    """
+    :return: a cheap content digest of a frame, used to detect changed data
+    """
+    return str(int(pd.util.hash_pandas_object(df, index=False).sum()))
+
+
+def write_frame(key, df):
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    # uncompressed, so that readers can map the buffers instead of decoding them
+    _write_atomically(_path(f"{key}.arrow"),
+                      lambda path: feather.write_feather(table, path, compression="uncompressed"))
+
+
+def read_frame(key):
+    """
+    Memory-maps the cached frame of `key`
+    :return: pandas df, or None if the key was never written
+    """
+    try:
+        table = feather.read_table(_path(f"{key}.arrow"), memory_map=True)
+    except FileNotFoundError:
+        return None
+    # the string columns stay Arrow arrays over the mapped buffers: converting
+    # them to Python strings would give every worker its own copy of the data
+    return table.to_pandas(types_mapper=_arrow_backed_strings)
+
+
+def _arrow_backed_strings(arrow_type):
+    if pa.types.is_string(arrow_type) or pa.types.is_large_string(arrow_type):
+        return pd.ArrowDtype(arrow_type)
+    return None
+
+
+def _usable(entry, previous, max_age, retry_interval, now):
+    fresh = now - entry.get("fetched_at", 0) <= max_age
+    recently_failed = entry.get("error") and now - entry.get("attempted_at", 0) <= retry_interval
+    return (fresh or recently_failed) and previous is not None
+
+
+def _read_entry_and_frame(key):
+    entry = read_manifest()["entries"].get(key, {})
+    # a frame the manifest does not know (a writer died before recording it,
+    # or the manifest was lost) cannot be served, it is rebuilt instead
+    previous = read_frame(key) if "fetched_at" in entry else None
+    return entry, previous
+
+
+def refresh(key, build, max_age, retry_interval):
+    """
+    Returns a fresh frame for `key`, rebuilding it in at most one process at a time
+    A usable entry is mapped without any lock, so readers never wait behind a
+    rebuild. Otherwise the caller holding the key's lock rebuilds the entry if
+    it is still older than `max_age`; callers that waited on the lock find the
+    entry fresh (or recently attempted) and map it instead of rebuilding it.
+    If `build` fails, the previous frame is returned with the error recorded.
+    :param key: the cache key
+    :param build: called as build(previous frame or None, manifest entry) only when needed;
+                  returns (frame, extra manifest fields). Returning the previous
+                  frame itself means nothing changed.
+    :param max_age: seconds after which the entry is rebuilt
+    :param retry_interval: seconds during which a failed rebuild is not retried
+    :return: (pandas df, manifest entry)
+    :raises: whatever `build` raised, if there is no previous frame to fall back to
+    """
+    entry, previous = _read_entry_and_frame(key)
+    if _usable(entry, previous, max_age, retry_interval, time.time()):
+        return previous, entry
+
+    with file_lock(key):
+        now = time.time()
+        entry, previous = _read_entry_and_frame(key)
+        if _usable(entry, previous, max_age, retry_interval, now):
+            return previous, entry
+
+        try:
+            df, extra = build(previous, entry)
+        except Exception as error:
+            entry = _update_manifest(key, attempted_at=now, error=str(error))
+            if previous is None:
+                raise
+            return previous, entry
+
+        if df is previous:
+            entry = _update_manifest(key, attempted_at=now, fetched_at=time.time(), error=None, **extra)
+            return previous, entry
+        write_frame(key, df)
+        entry = _update_manifest(key, attempted_at=now, fetched_at=time.time(),
+                                 digest=frame_digest(df), error=None, **extra)
+        # the writer too serves the mapped file, not the frame it built
+        return read_frame(key), entry
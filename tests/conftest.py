@@ -0,0 +1,58 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+import requests
+
+# the dashboard modules live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import data_loader  # noqa: E402
+import shared_cache  # noqa: E402
+
+
+def make_records(n, merhavim=("מרחב שפלה", "מרחב דן תא"), groups=("עבירות מרמה", "עבירות תנועה"), seed=0):
+    rng = np.random.default_rng(seed)
+    return [
+        {"_id": i + 1, "Quarter": f"Q{rng.integers(1, 5)}", "PoliceDistrict": "מרכז",
+         "PoliceMerhav": rng.choice(merhavim), "StatisticGroup": rng.choice(groups)}
+        for i in range(n)
+    ]
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(shared_cache, "CACHE_DIR", str(tmp_path))
+    return tmp_path
+
+
+class FakeDatastore:
+    """
+    Serves one resource like data.gov.il, capping every page at `cap` records
+    With `sql_status` set, the SQL endpoint answers every query with that HTTP status.
+    """
+
+    def __init__(self, records, cap=100, sql_status=None):
+        self.records = records
+        self.cap = cap
+        self.sql_status = sql_status
+        self.calls = []
+
+    def __call__(self, url, params=None, timeout=None):
+        self.calls.append((url, params))
+        if url == data_loader.SQL_URL and self.sql_status is not None:
+            response = requests.Response()
+            response.status_code = self.sql_status
+            return response
+        if url == data_loader.SQL_URL:
+            after_id = int(params["sql"].split("_id > ")[1].split()[0])
+            page = [dict(record, _full_text="") for record in self.records if record["_id"] > after_id]
+            result = {"records": page[:self.cap]}
+        else:
+            offset, limit = params["offset"], min(params["limit"], self.cap)
+            result = {"records": self.records[offset:offset + limit], "total": len(self.records)}
+        response = requests.Response()
+        response.status_code = 200
+        response.json = lambda: {"success": True, "result": result}
+        return response
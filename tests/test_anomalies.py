@@ -0,0 +1,20 @@
+"""
+Robust seasonal z-scores of the anomaly layer.
+"""
+import numpy as np
+
+import anomalies
+
+
+def test_seasonal_zscores_flag_a_spike():
+    quarters = [f"{year}-Q{quarter}" for year in range(2018, 2025) for quarter in range(1, 5)]
+    rng = np.random.default_rng(0)
+    counts = rng.poisson(50, size=(3, len(quarters))).astype(float)
+    counts[1, quarters.index("2022-Q3")] += 200
+
+    baseline, zscores = anomalies.seasonal_zscores(counts, quarters)
+
+    flagged = np.argwhere(np.abs(zscores) >= anomalies.Z_THRESHOLD)
+    assert flagged.tolist() == [[1, quarters.index("2022-Q3")]]
+    same_quarter = [i for i, quarter in enumerate(quarters) if quarter.endswith("Q3")]
+    assert baseline[1, quarters.index("2022-Q3")] == np.median(counts[1, same_quarter])
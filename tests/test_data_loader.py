@@ -0,0 +1,75 @@
+"""
+Fetching the data.gov.il resources.
+"""
+import threading
+import time
+
+import pytest
+import requests
+
+import data_loader
+import shared_cache
+from conftest import FakeDatastore, make_records
+
+
+@pytest.fixture
+def fresh_loader(cache_dir, monkeypatch):
+    """A data_loader in the state of a newly started worker, serving only the 2020 resource."""
+    monkeypatch.setattr(data_loader, "RESOURCE_IDS", {2020: data_loader.RESOURCE_IDS[2020]})
+    monkeypatch.setattr(data_loader, "_breakers", {2020: data_loader.CircuitBreaker()})
+    monkeypatch.setattr(data_loader, "_snapshots", {})
+    monkeypatch.setattr(data_loader, "_refreshing", set())
+    monkeypatch.setattr(data_loader, "_attempted_at", {})
+    monkeypatch.setattr(data_loader, "_cold_started", False)
+    monkeypatch.setattr(data_loader, "_combined", None)
+    monkeypatch.setattr(data_loader, "_manifest_mtime", None)
+    return data_loader
+
+
+def test_fetch_records_pages_through_the_whole_resource(monkeypatch):
+    datastore = FakeDatastore(make_records(450))
+    monkeypatch.setattr(data_loader.requests, "get", datastore)
+    records = data_loader.fetch_records(2020)
+    assert [record["_id"] for record in records] == list(range(1, 451))
+
+
+def test_cold_start_serves_a_stale_cache_without_waiting_for_upstream(fresh_loader, monkeypatch):
+    shared_cache.refresh(
+        "2020", lambda previous, entry: (data_loader.prepare_records(make_records(50), 2020), {}), 0, 0
+    )
+    old = time.time() - 2 * data_loader.REFRESH_INTERVAL
+    shared_cache._update_manifest("2020", fetched_at=old, full_fetched_at=old)
+
+    release = threading.Event()
+
+    def hanging_upstream(url, params=None, timeout=None):
+        release.wait(5)
+        raise requests.Timeout("upstream timed out")
+
+    monkeypatch.setattr(data_loader.requests, "get", hanging_upstream)
+    monkeypatch.setattr(data_loader, "MAX_ATTEMPTS", 1)
+    try:
+        started = time.time()
+        df, status = data_loader.get_crime_data()
+        assert time.time() - started < 1
+        assert len(df) == 50
+        assert status.stale_years == [2020]
+        assert status.refreshing
+    finally:
+        release.set()
+        # the background refresh must be done before the cache directory is restored
+        deadline = time.time() + 5
+        while data_loader._refreshing and time.time() < deadline:
+            time.sleep(0.01)
+    assert not data_loader._refreshing
+
+
+def test_cold_start_rebuilds_a_frame_the_manifest_does_not_know(fresh_loader, monkeypatch):
+    # a worker died between writing the frame and recording it in the manifest
+    shared_cache.write_frame("2020", data_loader.prepare_records(make_records(10), 2020))
+    monkeypatch.setattr(data_loader.requests, "get", FakeDatastore(make_records(50)))
+
+    df, status = data_loader.get_crime_data()
+
+    assert len(df) == 50
+    assert not status.is_degraded
@@ -0,0 +1,95 @@
+"""
+Invariants of the incremental pipeline: appended records and the aggregates merged from them.
+"""
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+import aggregations
+import data_loader
+from conftest import FakeDatastore, make_records
+
+
+def test_fetch_records_after_id_returns_only_new_records(monkeypatch):
+    records = [record for record in make_records(450) if not 200 < record["_id"] < 210]  # a gap in the ids
+    datastore = FakeDatastore(records)
+    monkeypatch.setattr(data_loader.requests, "get", datastore)
+    new_records = data_loader.fetch_records(2020, after_id=150)
+    assert [record["_id"] for record in new_records] == [r["_id"] for r in records if r["_id"] > 150]
+    assert all("_full_text" not in record for record in new_records)
+
+
+def test_fetch_records_after_id_falls_back_to_a_full_read_when_sql_is_rejected(monkeypatch):
+    records = make_records(450)
+    datastore = FakeDatastore(records, sql_status=403)
+    monkeypatch.setattr(data_loader.requests, "get", datastore)
+    monkeypatch.setattr(data_loader, "_breakers", {2020: data_loader.CircuitBreaker()})
+
+    new_records = data_loader.fetch_records(2020, after_id=150)
+
+    assert [record["_id"] for record in new_records] == list(range(151, 451))
+    assert [url for url, _ in datastore.calls].count(data_loader.SQL_URL) == 1  # not retried
+    assert not data_loader._breakers[2020].failures
+
+
+def test_merged_cube_equals_full_rebuild():
+    df = data_loader.prepare_records(make_records(2000), 2023)
+    old, new = df.iloc[:1500], df.iloc[1500:]
+    merged = aggregations.build_crime_cube(old).merged(aggregations.build_crime_cube(new))
+    rebuilt = aggregations.build_crime_cube(df)
+    assert (merged.merhavim, merged.categories, merged.quarters) == \
+        (rebuilt.merhavim, rebuilt.categories, rebuilt.quarters)
+    np.testing.assert_array_equal(merged.counts, rebuilt.counts)
+
+
+def test_statistic_group_cube_of_an_appended_snapshot_aggregates_only_the_new_rows(monkeypatch):
+    monkeypatch.setattr(aggregations, "_cube_cache", {})
+    monkeypatch.setattr(data_loader, "_combined", None)
+    monkeypatch.setattr(data_loader, "_combined_versions", deque(maxlen=data_loader.APPEND_HISTORY))
+    df = data_loader.prepare_records(make_records(2000), 2023)
+    old, new = df.iloc[:1500].reset_index(drop=True), df
+    data_loader._set_combined(old, appended=False)
+    data_loader._set_combined(new, appended=True)
+    built = []
+    build_crime_cube = aggregations.build_crime_cube
+    monkeypatch.setattr(aggregations, "build_crime_cube",
+                        lambda rows, column="Category": built.append(len(rows)) or build_crime_cube(rows, column))
+
+    aggregations.get_crime_cube(old, "StatisticGroup")
+    cube = aggregations.get_crime_cube(new, "StatisticGroup")
+
+    assert built == [1500, 500]
+    np.testing.assert_array_equal(cube.counts, build_crime_cube(new, "StatisticGroup").counts)
+
+
+def test_district_periods_of_an_appended_snapshot_equal_a_full_rebuild(monkeypatch):
+    monkeypatch.setattr(aggregations, "_district_periods_cache", (None, None, None))
+    monkeypatch.setattr(data_loader, "_combined", None)
+    monkeypatch.setattr(data_loader, "_combined_versions", deque(maxlen=data_loader.APPEND_HISTORY))
+    old = data_loader.prepare_records(make_records(1500), 2023)
+    new_rows = data_loader.prepare_records(make_records(500, seed=1), 2024)
+    new_rows["PoliceDistrict"] = "דרום"
+    new = pd.concat([old, new_rows], ignore_index=True)
+    data_loader._set_combined(old, appended=False)
+    data_loader._set_combined(new, appended=True)
+
+    aggregations.get_district_periods(old)
+    pd.testing.assert_frame_equal(aggregations.get_district_periods(new),
+                                  aggregations.build_district_periods(new))
+
+
+def test_merge_bumps_only_the_keys_of_touched_slices():
+    df = data_loader.prepare_records(make_records(2000), 2023)
+    cube = aggregations.build_crime_cube(df)
+    new_rows = data_loader.prepare_records(
+        make_records(10, merhavim=("מרחב שפלה",), groups=("עבירות מרמה",), seed=1), 2023
+    )
+    merged = cube.merged(aggregations.build_crime_cube(new_rows))
+
+    assert merged.merhav_key("מרחב שפלה") != cube.merhav_key("מרחב שפלה")
+    assert merged.merhav_key("מרחב דן") == cube.merhav_key("מרחב דן")
+    assert merged.category_key("עבירות מרמה") != cube.category_key("עבירות מרמה")
+    assert merged.category_key("עבירות תנועה") == cube.category_key("עבירות תנועה")
+    assert merged.merhav_key() != cube.merhav_key()
+    assert merged.axes_version == cube.axes_version
@@ -0,0 +1,60 @@
+"""
+Sharing the fetched resources between worker processes through the on-disk cache.
+"""
+import threading
+import time
+
+import pandas as pd
+import pytest
+
+import data_loader
+import shared_cache
+
+
+def test_refresh_builds_once_for_concurrent_callers(cache_dir):
+    builds = []
+
+    def build(previous, entry):
+        builds.append(previous)
+        time.sleep(0.2)
+        return pd.DataFrame({"a": [1, 2, 3]}), {}
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(shared_cache.refresh("key", build, 60, 60)))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(builds) == 1
+    assert [frame["a"].tolist() for frame, _ in results] == [[1, 2, 3]] * 4
+
+
+def test_refresh_falls_back_to_the_previous_frame_on_error(cache_dir):
+    shared_cache.refresh("key", lambda previous, entry: (pd.DataFrame({"a": [1]}), {}), 0, 0)
+
+    def failing_build(previous, entry):
+        raise data_loader.UpstreamUnavailable("down")
+
+    frame, entry = shared_cache.refresh("key", failing_build, 0, 0)
+    assert frame["a"].tolist() == [1]
+    assert entry["error"] == "down"
+
+    with pytest.raises(data_loader.UpstreamUnavailable):
+        shared_cache.refresh("other", failing_build, 0, 0)
+
+
+def test_a_usable_entry_is_mapped_while_another_process_rebuilds_it(cache_dir):
+    shared_cache.refresh("key", lambda previous, entry: (pd.DataFrame({"a": [1]}), {}), 0, 0)
+    results = []
+    with shared_cache.file_lock("key"):  # held by a process rebuilding the key
+        reader = threading.Thread(target=lambda: results.append(
+            shared_cache.refresh("key", lambda previous, entry: pytest.fail("rebuilt"), float("inf"), 0)
+        ))
+        reader.start()
+        reader.join(2)
+        assert not reader.is_alive()
+    assert results[0][0]["a"].tolist() == [1]
@@ -0,0 +1,46 @@
+"""
+The TileJSON documents, cache headers and map layers of the boundary tiles.
+"""
+import base64
+import json
+
+import pytest
+
+import boundaries
+import vector_tiles
+
+
+@pytest.fixture
+def tiles_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(vector_tiles, "TILES_DIR", str(tmp_path))
+    layer = {"minzoom": 4, "maxzoom": 12, "bounds": [34, 29, 36, 33], "vector_layers": [], "tile_count": 1}
+    (tmp_path / vector_tiles.METADATA).write_text(json.dumps({"layers": {"merhav": layer}, "build_id": "42"}))
+    tile = tmp_path / "merhav" / "8" / "152" / "104.pbf"
+    tile.parent.mkdir(parents=True)
+    tile.write_bytes(b"tile")
+    return tmp_path
+
+
+def test_layers_follow_the_built_layers(tiles_dir):
+    sources = vector_tiles.tile_sources("https://example.org/app/static/tiles", inline=True)
+    assert list(sources) == ["merhav"]
+    assert [layer["sourcelayer"] for layer in vector_tiles.boundary_layers(sources)] == ["merhav"]
+
+    tilejson = json.loads(base64.b64decode(sources["merhav"].split(",", 1)[1]))
+    assert tilejson["tiles"] == ["https://example.org/app/static/tiles/merhav/{z}/{x}/{y}.pbf?v=42"]
+    assert vector_tiles.tile_response("/station.json", "https://example.org/tiles")[0] == 404
+
+
+def test_only_the_urls_of_the_current_build_are_immutable(tiles_dir):
+    status, headers, body = vector_tiles.tile_response("/merhav/8/152/104.pbf", "/tiles", version="42")
+    assert (status, body) == (200, b"tile")
+    assert "immutable" in headers["Cache-Control"]
+
+    status, headers, _ = vector_tiles.tile_response("/merhav/8/152/104.pbf", "/tiles", version="41")
+    assert headers["Cache-Control"] == "no-cache"
+    status, _, _ = vector_tiles.tile_response("/merhav/8/152/104.pbf", "/tiles", if_none_match=headers["ETag"])
+    assert status == 304
+
+
+def test_the_fill_lines_up_with_the_outlines_of_every_zoom_they_are_drawn_at():
+    assert boundaries.FILL_MAX_ZOOM >= max(spec["maxzoom"] for spec in vector_tiles.LAYERS.values())
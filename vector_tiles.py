@@ -0,0 +1,266 @@
+"""
+Vector tiles (MVT) of the police boundary layers and a small server for them.
+
+Embedding the boundaries as GeoJSON puts every vertex of every polygon in every
+figure (~7MB for the merhavim alone, three times that with the stations). The
+build step cuts the layers of policestationboundaries.gdb.zip into Mapbox
+vector tiles, simplified to the resolution of each zoom level:
+
+    python vector_tiles.py build
+
+The maps then read the outlines from the tiles, so the browser downloads only
+the tiles of the visible extent and zoom and caches them across sessions. The
+tiles of a layer are at `<layer>/<z>/<x>/<y>.pbf` under TILES_DIR, which
+defaults to `static/tiles`: Streamlit serves them from the dashboard's own
+origin (server.enableStaticServing, see .streamlit/config.toml) and dash_app.py
+under its /tiles route. They are stored uncompressed, as static file serving
+cannot mark them gzip-encoded. The CRIME_TILES_URL environment variable points
+the maps at a copy of TILES_DIR published elsewhere (a CDN, or
+`python vector_tiles.py serve` behind the same reverse proxy) instead.
+
+Every tile URL carries the build id (`?v=<build_id>`), so a rebuild changes
+the URLs and the tiles themselves can be cached as immutable.
+
+Requires mapbox-vector-tile and mercantile for the build step only.
+"""
+import argparse
+import base64
+import json
+import os
+import re
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from shapely import box, clip_by_rect
+
+TILES_DIR = os.environ.get("CRIME_TILES_DIR", os.path.join("static", "tiles"))
+METADATA = "metadata.json"
+TILE_HOST = "127.0.0.1"
+TILE_PORT = int(os.environ.get("CRIME_TILES_PORT", 8765))
+EXTENT = 4096  # tile coordinate resolution
+BUFFER = 64  # tile units drawn past the tile edge, so that outlines meet without seams
+IMMUTABLE = "public, max-age=31536000, immutable"  # for the URLs of the current build only
+WEB_MERCATOR_WIDTH = 2 * 20037508.342789244  # meters
+
+# tile layer -> source layer in the geodatabase, attributes kept, zoom range
+LAYERS = {
+    "mahoz": {"source": "PoliceMahozBoundaries", "fields": ["MahozName"], "minzoom": 4, "maxzoom": 10},
+    "merhav": {"source": "PoliceMerhavBoundaries", "fields": ["MerhavName", "MahozName"],
+               "minzoom": 4, "maxzoom": 12},
+    "station": {"source": "PoliceStationBoundaries", "fields": ["TahanaName", "MerhavName", "MahozName"],
+                "minzoom": 8, "maxzoom": 13},
+}
+
+# how the outlines of every layer are drawn, bottom to top
+LAYER_STYLES = {
+    "station": dict(color="#9e9e9e", opacity=0.8, line=dict(width=0.5)),
+    "merhav": dict(color="#424242", line=dict(width=1)),
+    "mahoz": dict(color="#212121", line=dict(width=2)),
+}
+
+TILE_PATH = re.compile(r"^/(?P<layer>\w+)/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.pbf$")
+TILEJSON_PATH = re.compile(r"^/(?P<layer>\w+)\.json$")
+
+
+def build_layer(name, spec):
+    """
+    Writes the tiles of one layer to TILES_DIR/<name>/<z>/<x>/<y>.pbf
+    :param name: the tile layer name
+    :param spec: the entry of LAYERS
+    :return: the TileJSON fields of the layer
+    """
+    import mapbox_vector_tile
+    import mercantile
+    from boundaries import read_boundary_layer
+
+    gdf = read_boundary_layer(spec["source"], epsg=3857)
+    west, south, east, north = gdf.to_crs(epsg=4326).total_bounds
+    properties = gdf[spec["fields"]].fillna("").to_dict("records")
+    tile_count = 0
+
+    for zoom in range(spec["minzoom"], spec["maxzoom"] + 1):
+        tile_width = WEB_MERCATOR_WIDTH / 2 ** zoom
+        # details below one tile unit are invisible at this zoom
+        geometries = gdf.geometry.simplify(tile_width / EXTENT, preserve_topology=True)
+        for tile in mercantile.tiles(west, south, east, north, zooms=zoom):
+            bounds = mercantile.xy_bounds(tile)
+            margin = tile_width * BUFFER / EXTENT
+            clip_bounds = (bounds.left - margin, bounds.bottom - margin,
+                           bounds.right + margin, bounds.top + margin)
+            features = []
+            for i in geometries.sindex.query(box(*clip_bounds), predicate="intersects"):
+                geometry = clip_by_rect(geometries.iloc[i], *clip_bounds)
+                if not geometry.is_empty:
+                    features.append({"geometry": geometry, "properties": properties[i]})
+            if not features:
+                continue
+
+            data = mapbox_vector_tile.encode(
+                [{"name": name, "features": features}],
+                default_options={"quantize_bounds": tuple(bounds), "extents": EXTENT},
+            )
+            path = os.path.join(TILES_DIR, name, str(tile.z), str(tile.x), f"{tile.y}.pbf")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as tile_file:
+                tile_file.write(data)
+            tile_count += 1
+
+    return {
+        "minzoom": spec["minzoom"],
+        "maxzoom": spec["maxzoom"],
+        "bounds": [float(west), float(south), float(east), float(north)],
+        "vector_layers": [{"id": name, "fields": {field: "String" for field in spec["fields"]},
+                           "minzoom": spec["minzoom"], "maxzoom": spec["maxzoom"]}],
+        "tile_count": tile_count,
+    }
+
+
+def build_tiles(layers=None):
+    """
+    Builds the tiles of the given layers and records them in TILES_DIR/metadata.json
+    :param layers: names of LAYERS to build (None for all)
+    :return: the metadata dict
+    """
+    metadata = read_metadata() or {"layers": {}}
+    for name in layers or LAYERS:
+        metadata["layers"][name] = build_layer(name, LAYERS[name])
+    # identifies this build, the tile URLs change with it
+    metadata["build_id"] = str(int(time.time()))
+    with open(os.path.join(TILES_DIR, METADATA), "w", encoding="utf-8") as metadata_file:
+        json.dump(metadata, metadata_file, indent=2)
+    return metadata
+
+
+def read_metadata():
+    """
+    :return: the metadata of the built tiles, or None if they were not built
+    """
+    try:
+        with open(os.path.join(TILES_DIR, METADATA), encoding="utf-8") as metadata_file:
+            return json.load(metadata_file)
+    except FileNotFoundError:
+        return None
+
+
+def tilejson(layer, tiles_url, metadata):
+    """
+    :param layer: a built tile layer
+    :param tiles_url: the public URL TILES_DIR is published at
+    :param metadata: the metadata of the build
+    :return: the TileJSON document of the layer, with the build id in its tile URLs
+    """
+    return dict(metadata["layers"][layer], tilejson="2.2.0", name=layer, scheme="xyz",
+                tiles=[f"{tiles_url.rstrip('/')}/{layer}/{{z}}/{{x}}/{{y}}.pbf?v={metadata['build_id']}"])
+
+
+def tile_response(path, base_url, version=None, if_none_match=None):
+    """
+    Answers a request for a TileJSON document or a tile, for any HTTP server
+    :param path: the request path, relative to where the tiles are mounted (e.g. "/merhav/8/152/104.pbf")
+    :param base_url: the public URL the tiles are mounted at, used in the TileJSON documents
+    :param version: the `v` query parameter of the request
+    :param if_none_match: the If-None-Match header of the request
+    :return: (status, headers dict, body bytes)
+    """
+    metadata = read_metadata()
+    headers = {"Access-Control-Allow-Origin": "*"}
+    if metadata is None:
+        return 404, headers, b""
+
+    match = TILEJSON_PATH.match(path)
+    if match and match["layer"] in metadata["layers"]:
+        headers.update({"Content-Type": "application/json", "Cache-Control": "no-cache"})
+        return 200, headers, json.dumps(tilejson(match["layer"], base_url, metadata)).encode("utf-8")
+
+    match = TILE_PATH.match(path)
+    if not match or match["layer"] not in metadata["layers"]:
+        return 404, headers, b""
+    etag = f'"{metadata["build_id"]}"'
+    # a URL of the current build never changes content; any other one is revalidated
+    headers.update({"Cache-Control": IMMUTABLE if version == metadata["build_id"] else "no-cache", "ETag": etag})
+    if if_none_match == etag:
+        return 304, headers, b""
+    try:
+        with open(os.path.join(TILES_DIR, *path.strip("/").split("/")), "rb") as tile_file:
+            body = tile_file.read()
+    except FileNotFoundError:
+        # inside the bounds but without any boundary: an empty tile
+        return 204, headers, b""
+    headers["Content-Type"] = "application/vnd.mapbox-vector-tile"
+    return 200, headers, body
+
+
+class TileRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        base_url = f"http://{self.headers.get('Host', f'{TILE_HOST}:{TILE_PORT}')}"
+        url = urlsplit(self.path)
+        status, headers, body = tile_response(url.path, base_url, parse_qs(url.query).get("v", [None])[0],
+                                              self.headers.get("If-None-Match"))
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # tile requests are far too many to log
+
+
+def tile_sources(tiles_url, inline=False):
+    """
+    The vector sources of the built layers, for boundary_layers
+    :param tiles_url: the public URL TILES_DIR is published at
+    :param inline: embed the TileJSON documents as data URLs, for hosts serving the tile files only
+                   (tiles_url must then be absolute: MapLibre loads the tiles from a worker)
+    :return: dict of layer -> TileJSON URL, or None if the tiles were not built
+    """
+    metadata = read_metadata()
+    if metadata is None:
+        return None
+    if not inline:
+        return {layer: f"{tiles_url.rstrip('/')}/{layer}.json" for layer in metadata["layers"]}
+    return {
+        layer: "data:application/json;base64,"
+               + base64.b64encode(json.dumps(tilejson(layer, tiles_url, metadata)).encode("utf-8")).decode("ascii")
+        for layer in metadata["layers"]
+    }
+
+
+def boundary_layers(sources):
+    """
+    Map layers drawing the boundary outlines from the tiles, for layout.map.layers
+    :param sources: the tile_sources of the built layers
+    :return: list of plotly map layer dicts, one per built layer
+    """
+    return [
+        dict(sourcetype="vector", source=sources[layer], sourcelayer=layer, type="line",
+             minzoom=LAYERS[layer]["minzoom"], **style)
+        for layer, style in LAYER_STYLES.items() if layer in sources
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="cut the boundary layers into tiles")
+    build_parser.add_argument("--layers", nargs="+", choices=list(LAYERS), help="layers to build (default: all)")
+    serve_parser = subparsers.add_parser("serve", help="serve the built tiles")
+    serve_parser.add_argument("--host", default=TILE_HOST)
+    serve_parser.add_argument("--port", type=int, default=TILE_PORT)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        started = time.perf_counter()
+        metadata = build_tiles(args.layers)
+        for name, layer in metadata["layers"].items():
+            print(f"{name}: {layer['tile_count']} tiles, zoom {layer['minzoom']}-{layer['maxzoom']}")
+        print(f"built in {time.perf_counter() - started:.1f}s into {TILES_DIR}")
+    else:
+        print(f"serving {TILES_DIR} on http://{args.host}:{args.port}")
+        ThreadingHTTPServer((args.host, args.port), TileRequestHandler).serve_forever()
+
+
+if __name__ == "__main__":
+    main()